@@ -1,10 +1,15 @@
 # common functions used across the whole package
 
 import re
-import json
+import sys
+import functools
+import collections
+import set_files
 
 """
 # objects (set, card, scenario, etc) are stored as simple dicts for convenience.
+# Sets, cards, sides and scenarios can also be the typed objects defined below
+# (ArkhamSet, Card, Side, Scenario), which support the same dict-style access.
 
 set_type_enum = [
   'Core Set',
@@ -29,6 +34,8 @@ card = {
   'encounter_set': string,
   'front': side,
   'back': side,
+  'source_url': string,     # cardgamedb page the card was scraped from
+  'page_hash': string,      # sha256 of the card's content on that page
 }
 
 
@@ -112,47 +119,251 @@ side_data_fields_with_possible_symbols = [
 octgn_game_id = 'a6d114c7-2e2a-4896-ad8c-0330605c90bf'
 
 
+# Build a function that replaces every key of symbol_map found in a string with
+# the corresponding value. The string is scanned once, trying longer keys first
+# where several keys match at the same position.
+def make_symbol_translator(symbol_map):
+    keys = sorted((k for k in symbol_map if k), key=len, reverse=True)
+    if not keys:
+        return lambda text: text
+    pattern = re.compile('|'.join(re.escape(k) for k in keys))
+
+    def replace(match):
+        return symbol_map[match.group(0)]
+
+    def translate(text):
+        return pattern.sub(replace, text)
+
+    return translate
+
+
 def is_double_sided(card):
     return 'back' in card
 
 
+# A card number is digits, optionally followed by a letter suffix (as on some
+# promo cards) and then "a" or "b" for the front or back of a card whose sides
+# are listed separately. Sets can also use numbers that don't fit this pattern,
+# which are sorted after all the others.
+card_number_re = re.compile(r'(\d+)(\D*?)([ab]?)$')
+card_face_re = re.compile(r'(.*\d\D*?)([ab])$')
+
+card_faces = {'': '', 'a': 'front', 'b': 'back'}
+
+CardNumberKey = collections.namedtuple(
+    'CardNumberKey', ['rank', 'number', 'text', 'suffix', 'face'])
+
+# sort key of cards without a number, after all the others
+missing_card_number_key = CardNumberKey(2, 0, '', '', '')
+
+
 # remove trailing a or b from number, return number and face
 def get_number_and_face(number):
-    m = re.match('^(\d+)([ab]?)$', number)
-    if not m:
+    if not number:
         raise ValueError
-    number = m.group(1)
-    if m.group(2) == 'a':
-        face = 'front'
-    elif m.group(2) == 'b':
-        face = 'back'
-    else:
-        face = ''
+    m = card_face_re.match(number)
+    if not m:
+        return number, ''
+    return m.group(1), card_faces[m.group(2)]
 
-    return number, face
 
+# The structured sort key for a card number. Numbers are parsed once and the
+# keys reused, since the same numbers come up in every set.
+@functools.lru_cache(maxsize=None)
+def get_card_number_key(number):
+    if not number:
+        return missing_card_number_key
+    m = card_number_re.match(number)
+    if not m:
+        return CardNumberKey(1, 0, number, '', '')
+    digits, suffix, face = m.groups()
+    return CardNumberKey(0, int(digits), '', suffix, face)
 
-# We want to sort first by number and then by a/b face indicator.
-# This would be easy to express as a binary comparison operator, but it's
-# annoying to do as a key unary operator.
+
+# Sort first by number, then by suffix, then by a/b face indicator.
 def card_number_sort_key(card):
-    number, face = get_number_and_face(card.get('number', '999'))
-    face = ord(face) if face else 0
-    return 100*int(number) + face
+    if isinstance(card, Card):
+        return get_card_number_key(card.number)
+    return get_card_number_key(card.get('number', ''))
+
+
+#
+# Typed versions of the set, card, side and scenario objects described above.
+# They keep their fields in slots, which takes much less memory than a dict per
+# object for large catalogs, and they can be used wherever the dict versions
+# are: card['front']['data'], 'back' in card, card.get('encounter_set', '')
+# etc. all work, with a field set to None counting as absent. Use from_dict and
+# to_dict to convert to and from the dict (JSON) format. from_dict raises
+# TypeError for keys that aren't fields, rather than silently dropping them.
+#
+
+
+# Subclasses list their fields in `fields`, and use them as their __slots__
+# along with any private slots.
+class Record:
+    __slots__ = ()
+    fields = ()
+
+    def __init__(self, **values):
+        for field in self.fields:
+            setattr(self, field, values.pop(field, None))
+        if values:
+            raise TypeError('{} has no fields {}'.format(
+                type(self).__name__, ', '.join(values)))
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__, ', '.join(
+            '{}={!r}'.format(k, getattr(self, k)) for k in self.fields
+            if getattr(self, k) is not None))
+
+    def __eq__(self, other):
+        return type(self) is type(other) and all(
+            getattr(self, k) == getattr(other, k) for k in self.fields)
+
+    def __getitem__(self, key):
+        if key in self.fields:
+            value = getattr(self, key)
+            if value is not None:
+                return value
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self.fields:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        self[key]
+        setattr(self, key, None)
+
+    def __contains__(self, key):
+        return key in self.fields and getattr(self, key) is not None
 
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
 
-def load_set(json_file_path):
-    with open(json_file_path, 'r') as json_file:
-        arkhamset = json.load(json_file)
+    def to_dict(self):
+        d = {}
+        for k in self.fields:
+            value = getattr(self, k)
+            if value is not None:
+                d[k] = to_plain_data(value)
+        return d
+
+
+# convert Records (possibly inside lists and dicts) to the dict format
+def to_plain_data(value):
+    if isinstance(value, Record):
+        return value.to_dict()
+    elif isinstance(value, list):
+        return [to_plain_data(v) for v in value]
+    elif isinstance(value, dict):
+        return {k: to_plain_data(v) for k, v in value.items()}
+    return value
+
+
+# Field names and other strings repeated across many cards are interned so
+# that all cards share one copy.
+def intern_keys(d):
+    return {sys.intern(k): v for k, v in d.items()}
+
+
+class Side(Record):
+    fields = ('name', 'image_url', 'data')
+    __slots__ = fields
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**dict(d, data=intern_keys(d.get('data', {}))))
+
+
+class Card(Record):
+    fields = (
+        'id', 'number', 'quantity', 'encounter_set', 'front', 'back', 'size',
+        'source_url', 'page_hash')
+    __slots__ = fields
+
+    @classmethod
+    def from_dict(cls, d):
+        values = dict(d, front=Side.from_dict(d['front']))
+        if 'back' in d:
+            values['back'] = Side.from_dict(d['back'])
+        if d.get('encounter_set'):
+            values['encounter_set'] = sys.intern(d['encounter_set'])
+        return cls(**values)
+
+    @property
+    def is_double_sided(self):
+        return self.back is not None
+
+
+# Scenario sections ('Act', 'Agenda' etc.) are kept in the sections dict, but
+# can be accessed as scenario[section] like the other fields. Scenario cards
+# are left as dicts.
+class Scenario(Record):
+    fields = ('number', 'name', 'campaign', 'campaign_code', 'sections')
+    __slots__ = fields
+
+    @classmethod
+    def from_dict(cls, d):
+        values = {k: d.get(k) for k in cls.fields if k != 'sections'}
+        sections = {k: v for k, v in d.items() if k not in values}
+        return cls(sections=sections, **values)
+
+    def __getitem__(self, key):
+        if key != 'sections' and key in self.sections:
+            return self.sections[key]
+        return super().__getitem__(key)
+
+    def __setitem__(self, key, value):
+        if key in self.fields:
+            super().__setitem__(key, value)
+        else:
+            self.sections[key] = value
+
+    def __contains__(self, key):
+        return key in self.sections or super().__contains__(key)
+
+    def to_dict(self):
+        d = super().to_dict()
+        d.update(d.pop('sections', {}))
+        return d
+
+
+class ArkhamSet(Record):
+    fields = ('id', 'name', 'type', 'cards', 'scenarios')
+    __slots__ = fields
+
+    @classmethod
+    def from_dict(cls, d):
+        values = dict(d, cards=[Card.from_dict(c) for c in d.get('cards', [])])
+        if 'scenarios' in d:
+            values['scenarios'] = [Scenario.from_dict(s) for s in d['scenarios']]
+        return cls(**values)
+
+
+# The file can be in any format set_files supports, chosen by its extension.
+# With typed=True, returns an ArkhamSet rather than a dict.
+def load_set(json_file_path, typed=False):
+    arkhamset = set_files.read_set_data(json_file_path)
+    if typed:
+        arkhamset = ArkhamSet.from_dict(arkhamset)
     return arkhamset
 
 
-def create_set_file(arkhamset, json_file_path=None):
+# The set's id, name, type and scenarios, and the number of cards in it as
+# 'num_cards', without loading the cards if the file format allows it.
+def load_set_info(path):
+    return set_files.read_set_info(path)
+
+
+# arkhamset may be a dict or an ArkhamSet. file_format ('json', 'json.gz' or
+# 'binary') is only used to choose the extension when no path is given.
+def create_set_file(arkhamset, json_file_path=None, file_format='json'):
     if json_file_path is None:
-        json_file_path = arkhamset['name'] + '.json'
-    try:
-        with open(json_file_path, 'w') as json_file:
-            json.dump(arkhamset, json_file)
-        return json_file_path
-    except:
-        raise
+        json_file_path = arkhamset['name'] + set_files.get_extension(file_format)
+    set_files.write_set_data(to_plain_data(arkhamset), json_file_path)
+    return json_file_path
@@ -3,6 +3,8 @@
 # way to enter missing data.
 
 import re
+import os
+import json
 import uuid
 import pickle
 import os.path
@@ -10,19 +12,37 @@ from googleapiclient.discovery import build
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 import arkham_common
+import profiling
 
-# If modifying these scopes, delete the file token.pickle.
-SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+# If the saved credentials in token.pickle don't cover these scopes, the user
+# is asked to log in again.
+SCOPES = [
+    'https://www.googleapis.com/auth/spreadsheets',
+    # to check when a spreadsheet was last modified (see read_set)
+    'https://www.googleapis.com/auth/drive.metadata.readonly',
+]
 
 sheet_template_filename = 'template.pickle'
 
+# cell ranges read from a set's spreadsheet, below the header rows
+set_info_range = 'Set!B2:B6'
+cards_range = 'Cards!A2:AD'
+scenarios_range = 'Scenarios!A2:K'
+
+# name, number, id, image url, quantity, encounter set; then side_data fields
+cards_sheet_fixed_columns = 6
+scenarios_sheet_columns = 11
+
+# directory for local copies of sets read from spreadsheets
+default_snapshot_dir = 'sheet_snapshots'
+
 
 class SheetDataError(Exception):
     """Base class for exceptions in this module."""
     pass
 
 
-def get_sheets_api_service():
+def get_credentials():
     creds = None
     # The file token.pickle stores the user's access and refresh tokens, and is
     # created automatically when the authorization flow completes for the first
@@ -30,6 +50,8 @@ def get_sheets_api_service():
     if os.path.exists('token.pickle'):
         with open('token.pickle', 'rb') as token:
             creds = pickle.load(token)
+    if creds and not creds.has_scopes(SCOPES):
+        creds = None
     # If there are no (valid) credentials available, let the user log in.
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
@@ -42,7 +64,16 @@ def get_sheets_api_service():
         with open('token.pickle', 'wb') as token:
             pickle.dump(creds, token)
 
-    service = build('sheets', 'v4', credentials=creds)
+    return creds
+
+
+def get_sheets_api_service(creds=None):
+    service = build('sheets', 'v4', credentials=creds or get_credentials())
+    return service
+
+
+def get_drive_api_service(creds=None):
+    service = build('drive', 'v3', credentials=creds or get_credentials())
     return service
 
 
@@ -51,18 +82,17 @@ def get_sheets_api_service():
 #
 
 
-def fill_set_info_sheet(service, spreadsheet_id, arkhamset):
-    range = 'Set!B2:B6'
-    value_input_option = 'USER_ENTERED'
+# The make_*_data functions build the ValueRange for each sheet we fill in, and
+# don't talk to the API, so all sheets can be written with one batchUpdate.
+
+
+def make_set_info_data(arkhamset):
     column = [arkhamset.get('id', ''), arkhamset['name'], '']
-    body = {
-        'range': range,
+    return {
+        'range': set_info_range,
         'values': [column],
         'majorDimension': 'COLUMNS',
     }
-    result = service.spreadsheets().values().update(
-        spreadsheetId=spreadsheet_id, range=range,
-        valueInputOption=value_input_option, body=body).execute()
 
 
 def make_row_for_card_side(card, face):
@@ -84,7 +114,7 @@ def make_row_for_card_side(card, face):
     return row
 
 
-def fill_cards_sheet(service, spreadsheet_id, arkhamset):
+def make_cards_data(arkhamset):
     rows = []
     arkhamset['cards'].sort(key=arkham_common.card_number_sort_key)
     for card in arkhamset['cards']:
@@ -98,21 +128,16 @@ def fill_cards_sheet(service, spreadsheet_id, arkhamset):
             new_rows = [make_row_for_card_side(card, '')]
         rows.extend(new_rows)
 
-    range = "Cards!A2:AD{}".format(1 + len(rows))
-    value_input_option = 'USER_ENTERED'
-    body = {
-        'range': range,
+    return {
+        'range': "Cards!A2:AD{}".format(1 + len(rows)),
         'values': rows,
     }
-    result = service.spreadsheets().values().update(
-        spreadsheetId=spreadsheet_id, range=range,
-        valueInputOption=value_input_option, body=body).execute()
 
 
 # We can pre-fill the scenario sheet even though we don't know the name of the
 # scenario(s) or the setup instructions. We'll just print all the scenario cards
 # from this set and let the user correct any errors.
-def fill_scenario_sheet_guess(service, spreadsheet_id, arkhamset):
+def make_scenario_sheet_guess_data(arkhamset):
     section_names = ['Act', 'Agenda', 'Location', 'Encounter', 'Setup',
                     'Special', 'Second Special']
     sections = {s: [] for s in section_names}
@@ -141,24 +166,64 @@ def fill_scenario_sheet_guess(service, spreadsheet_id, arkhamset):
             new_rows[0][0] = s
             rows.extend(new_rows)
 
-    range = "Scenarios!E2:I{}".format(1 + len(rows))
-    value_input_option = 'USER_ENTERED'
-    body = {
-        'range': range,
+    return {
+        'range': "Scenarios!E2:I{}".format(1 + len(rows)),
         'values': rows,
     }
-    result = service.spreadsheets().values().update(
-        spreadsheetId=spreadsheet_id, range=range,
-        valueInputOption=value_input_option, body=body).execute()
 
 
-def create_spreadsheet_for_set(arkhamset):
+# Request body for a values().batchUpdate writing all of the given ValueRanges.
+def make_batch_update_body(data):
+    return {
+        'valueInputOption': 'USER_ENTERED',
+        'data': data,
+    }
+
+
+# Fill in every sheet of a new spreadsheet with a single API request. The cards
+# sheet must be filled before the scenario sheet since it assigns card ids.
+def fill_spreadsheet(service, spreadsheet_id, arkhamset):
+    data = [
+        make_set_info_data(arkhamset),
+        make_cards_data(arkhamset),
+        make_scenario_sheet_guess_data(arkhamset),
+    ]
+    profiling.count('sheets.api_calls')
+    return service.spreadsheets().values().batchUpdate(
+        spreadsheetId=spreadsheet_id,
+        body=make_batch_update_body(data)).execute()
+
+
+def update_values(service, spreadsheet_id, value_range):
+    profiling.count('sheets.api_calls')
+    return service.spreadsheets().values().update(
+        spreadsheetId=spreadsheet_id, range=value_range['range'],
+        valueInputOption='USER_ENTERED', body=value_range).execute()
+
+
+def fill_set_info_sheet(service, spreadsheet_id, arkhamset):
+    return update_values(
+        service, spreadsheet_id, make_set_info_data(arkhamset))
+
+
+def fill_cards_sheet(service, spreadsheet_id, arkhamset):
+    return update_values(service, spreadsheet_id, make_cards_data(arkhamset))
+
+
+def fill_scenario_sheet_guess(service, spreadsheet_id, arkhamset):
+    return update_values(
+        service, spreadsheet_id, make_scenario_sheet_guess_data(arkhamset))
+
+
+@profiling.timer('create_spreadsheet')
+def create_spreadsheet_for_set(arkhamset, service=None):
     if 'id' not in arkhamset:
         arkhamset['id'] = str(uuid.uuid4())
 
-    print('Starting Google Sheets API Service... ', end='')
-    service = get_sheets_api_service()
-    print('Done.')
+    if service is None:
+        print('Starting Google Sheets API Service... ', end='')
+        service = get_sheets_api_service()
+        print('Done.')
 
     print('Creating template sheet... ', end='')
     with open(sheet_template_filename, 'rb') as sheet_template_file:
@@ -167,19 +232,12 @@ def create_spreadsheet_for_set(arkhamset):
     spreadsheet['properties']['title'] = 'Arkham Horror LCG: {}'.format(
         arkhamset['name'])
     spreadsheet = service.spreadsheets().create(body=spreadsheet).execute()
+    profiling.count('sheets.api_calls')
     spreadsheet_id = spreadsheet.get('spreadsheetId')
     print('Done, ID = {}.'.format(spreadsheet_id))
 
-    print('Filling set info sheet... ', end='')
-    fill_set_info_sheet(service, spreadsheet_id, arkhamset)
-    print('Done.')
-
-    print('Filling cards sheet... ', end='')
-    fill_cards_sheet(service, spreadsheet_id, arkhamset)
-    print('Done.')
-
-    print('Filling scenario sheet... ', end='')
-    fill_scenario_sheet_guess(service, spreadsheet_id, arkhamset)
+    print('Filling set info, cards and scenario sheets... ', end='')
+    fill_spreadsheet(service, spreadsheet_id, arkhamset)
     print('Done.')
 
     return spreadsheet.get('spreadsheetUrl')
@@ -190,22 +248,39 @@ def create_spreadsheet_for_set(arkhamset):
 #
 
 
+# The read_*_sheet functions take the rows of a sheet below the header row as
+# lists of strings, as returned by values().get/batchGet. The API leaves out
+# trailing empty cells and rows, so rows are padded before being read.
+
+
+def pad_row(row, width):
+    return row + [''] * (width - len(row))
+
+
+def get_string_from_value(value):
+    if isinstance(value, bool):
+        return 'TRUE' if value else 'FALSE'
+    return str(value)
+
+
 def get_string_from_cell(cell):
     return cell.get('userEnteredValue', {}).get('stringValue', '')
 
 
 def read_row(row):
-    return [get_string_from_cell(cell) for cell in row['values']]
+    return [get_string_from_cell(cell) for cell in row.get('values', [])]
 
 
-def read_set_info_sheet(sheet):
-    rows = sheet['data'][0]['rowData'][1:]
+# Convert a sheet from spreadsheets().get(includeGridData=True) to the rows
+# expected by the read_*_sheet functions.
+def read_grid_sheet(sheet):
+    return [read_row(row) for row in sheet['data'][0]['rowData'][1:]]
 
-    try:
-        column = [get_string_from_cell(row['values'][1]) for row in rows]
-        arkhamset = dict(zip(['id', 'name', 'type'], column))
-    except IndexError:
-        raise SheetDataError
+
+# rows: column B of the Set sheet, starting at row 2
+def read_set_info_sheet(rows):
+    column = [row[0] if row else '' for row in rows]
+    arkhamset = dict(zip(['id', 'name', 'type'], pad_row(column, 3)))
 
     if not arkhamset['name']:
         raise SheetDataError
@@ -213,14 +288,13 @@ def read_set_info_sheet(sheet):
     return arkhamset
 
 
-def read_cards_sheet(sheet):
-    rows = sheet['data'][0]['rowData'][1:]
-
+def read_cards_sheet(rows):
     incomplete_cards = {}
     cards = []
+    width = cards_sheet_fixed_columns + len(arkham_common.side_data)
 
     for row in rows:
-        name, number, id, image_url, quantity, encounter_set, *fields = read_row(row)
+        name, number, id, image_url, quantity, encounter_set, *fields = pad_row(row, width)
         if not name or not number:
             continue
 
@@ -272,8 +346,8 @@ def read_cards_sheet(sheet):
     return cards
 
 
-def read_scenarios_sheet(sheet):
-    rows = map(read_row, sheet['data'][0]['rowData'][1:])
+def read_scenarios_sheet(rows):
+    rows = [pad_row(row, scenarios_sheet_columns) for row in rows]
 
     scenario_dict = {}
 
@@ -325,18 +399,117 @@ def get_spreadsheet_id_from_url(url):
     return id
 
 
-def read_set(url, get_scenarios=True):
-    service = get_sheets_api_service()
-
-    spreadsheet_id = get_spreadsheet_id_from_url(url)
-    spreadsheet = service.spreadsheets().get(
-        spreadsheetId=spreadsheet_id, includeGridData=True).execute()
-
-    arkhamset = read_set_info_sheet(spreadsheet['sheets'][0])
-    arkhamset['cards'] = read_cards_sheet(spreadsheet['sheets'][1])
+# Fetch just the cell values we need from the spreadsheet in one request,
+# rather than the full grid data (with formatting) of every sheet.
+def read_set_from_service(service, spreadsheet_id, get_scenarios=True):
+    ranges = [set_info_range, cards_range]
     if get_scenarios:
-        arkhamset['scenarios'] = read_scenarios_sheet(spreadsheet['sheets'][2])
+        ranges.append(scenarios_range)
+    # FORMULA gives each cell's value as it was entered, like the
+    # userEnteredValue the grid data reads used, rather than the default
+    # FORMATTED_VALUE, which is the text shown in the sheet after number and
+    # date formatting. Entered numbers come back as numbers, so the cells are
+    # converted back to strings.
+    result = service.spreadsheets().values().batchGet(
+        spreadsheetId=spreadsheet_id, ranges=ranges, majorDimension='ROWS',
+        valueRenderOption='FORMULA').execute()
+    profiling.count('sheets.api_calls')
+    value_ranges = [[[get_string_from_value(v) for v in row]
+                     for row in r.get('values', [])]
+                    for r in result['valueRanges']]
+
+    arkhamset = read_set_info_sheet(value_ranges[0])
+    arkhamset['cards'] = read_cards_sheet(value_ranges[1])
+    if get_scenarios:
+        arkhamset['scenarios'] = read_scenarios_sheet(value_ranges[2])
     else:
         arkhamset['scenarios'] = []
+    profiling.count('sheets.cards_read', len(arkhamset['cards']))
+
+    return arkhamset
+
+
+#
+# Snapshots: local copies of sets read from spreadsheets, stored as
+# <snapshot_dir>/<spreadsheet id>.json along with the spreadsheet's Drive
+# modifiedTime when it was read.
+#
+
+
+def get_snapshot_path(snapshot_dir, spreadsheet_id):
+    return os.path.join(snapshot_dir, spreadsheet_id + '.json')
+
+
+def load_snapshot(snapshot_dir, spreadsheet_id):
+    try:
+        with open(get_snapshot_path(snapshot_dir, spreadsheet_id), 'r') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def save_snapshot(snapshot_dir, spreadsheet_id, snapshot):
+    os.makedirs(snapshot_dir, exist_ok=True)
+    path = get_snapshot_path(snapshot_dir, spreadsheet_id)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(path + '.tmp', path)
+
+
+def get_spreadsheet_modified_time(drive_service, spreadsheet_id):
+    metadata = drive_service.files().get(
+        fileId=spreadsheet_id, fields='modifiedTime').execute()
+    profiling.count('sheets.api_calls')
+    return metadata['modifiedTime']
+
+
+# Read a set from the spreadsheet at url.
+#
+# If snapshot_dir is given, the set is saved there after reading it, and the
+# saved copy is used instead as long as the spreadsheet hasn't been modified
+# since. With offline=True the saved copy is always used, without any network
+# access.
+#
+# service and drive_service are the Sheets and Drive API services to use; by
+# default they're created with the user's saved credentials.
+@profiling.timer('read_set')
+def read_set(url, get_scenarios=True, service=None, drive_service=None,
+             snapshot_dir=None, offline=False):
+    spreadsheet_id = get_spreadsheet_id_from_url(url)
+    if offline and not snapshot_dir:
+        snapshot_dir = default_snapshot_dir
+
+    creds = None
+    modified_time = None
+    if snapshot_dir:
+        snapshot = load_snapshot(snapshot_dir, spreadsheet_id)
+        usable = snapshot and (snapshot['get_scenarios'] or not get_scenarios)
+        if offline:
+            if not usable:
+                error_msg = "No snapshot of spreadsheet {} in {}".format(
+                    spreadsheet_id, snapshot_dir)
+                raise SheetDataError(error_msg)
+            profiling.count('sheets.snapshots_used')
+            return snapshot['arkhamset']
+
+        if drive_service is None:
+            creds = get_credentials()
+            drive_service = get_drive_api_service(creds)
+        modified_time = get_spreadsheet_modified_time(
+            drive_service, spreadsheet_id)
+        if usable and snapshot['modified_time'] == modified_time:
+            profiling.count('sheets.snapshots_used')
+            return snapshot['arkhamset']
+
+    if service is None:
+        service = get_sheets_api_service(creds)
+    arkhamset = read_set_from_service(service, spreadsheet_id, get_scenarios)
+
+    if snapshot_dir:
+        save_snapshot(snapshot_dir, spreadsheet_id, {
+            'modified_time': modified_time,
+            'get_scenarios': get_scenarios,
+            'arkhamset': arkhamset,
+        })
 
     return arkhamset
@@ -0,0 +1,681 @@
+#!/usr/bin/env python3
+
+# Benchmarks for the performance sensitive parts of the package, run against
+# the sets in example_files and against synthetic catalogs made from their
+# cards. Run with no arguments to run every benchmark, or give the names of the
+# benchmarks to run. --cards sets the size of the synthetic catalogs.
+#
+# --json saves the results to a file, and --compare shows how the results
+# compare to ones saved earlier, e.g. from before a change:
+#   git stash && ./benchmarks.py --json before.json && git stash pop
+#   ./benchmarks.py --compare before.json
+
+import os
+import re
+import sys
+import copy
+import glob
+import json
+import uuid
+import random
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+import xml.etree.ElementTree as ET
+import arkham_common
+import arkham_sheets
+import cardgamedb_scraper
+import fake_services
+import http_cache
+import octgn_package
+import set_files
+from bs4 import BeautifulSoup
+
+
+package_dir = os.path.dirname(os.path.abspath(__file__))
+example_files_dir = os.path.join(package_dir, 'example_files')
+
+default_num_cards = 10000
+
+# every result printed by print_result, for --json
+results = []
+
+
+def get_example_set_paths():
+    return sorted(glob.glob(os.path.join(example_files_dir, '*.xml')))
+
+
+# Call fn(*setup()) `repeat` times and return the fastest time in seconds.
+# setup is not timed.
+def time_function(fn, repeat=5, setup=tuple):
+    best = None
+    for _ in range(repeat):
+        args = setup()
+        start = time.perf_counter()
+        fn(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def print_result(benchmark, variant, seconds, count=None, unit='items'):
+    results.append({'benchmark': benchmark, 'variant': variant,
+                    'seconds': seconds, 'count': count, 'unit': unit})
+    line = '{:<12} {:<24} {:10.3f} ms'.format(benchmark, variant, seconds * 1000)
+    if count:
+        line += '  ({:,.0f} {}/s)'.format(count / seconds, unit)
+    print(line)
+
+
+#
+# example and synthetic sets
+#
+
+
+# Read an OCTGN set.xml back into a set. Its text is already in OCTGN format,
+# which formatting it for OCTGN again leaves as it is.
+def load_example_set(path):
+    root = ET.parse(path).getroot()
+    cards = []
+    for tag in root.iterfind('./cards/card'):
+        card = {'id': tag.attrib['id'], 'number': '', 'quantity': '1',
+                'front': {'name': tag.attrib['name'], 'data': {}}}
+        for prop in tag.iterfind('property'):
+            name, value = prop.attrib['name'], prop.attrib['value']
+            if name in octgn_package.scenario_card_properties:
+                card[octgn_package.scenario_card_properties[name]] = value
+            else:
+                card['front']['data'][name] = value
+        alternate = tag.find('alternate')
+        if alternate is not None:
+            card['back'] = {'name': alternate.attrib['name'], 'data': {
+                prop.attrib['name']: prop.attrib['value']
+                for prop in alternate.iterfind('property')
+                if prop.attrib['name'] != 'Encounter Set'}}
+        cards.append(card)
+    return {'id': root.attrib['id'], 'name': root.attrib['name'],
+            'type': 'Other', 'cards': cards}
+
+
+def load_example_sets():
+    return [load_example_set(path) for path in get_example_set_paths()]
+
+
+def make_uuid(rng):
+    return str(uuid.UUID(int=rng.getrandbits(128), version=4))
+
+
+# A set of num_cards cards picked at random from the example sets, with new ids,
+# numbers and image URLs. Encounter cards are put in encounter sets of 20
+# cards.
+def make_synthetic_set(num_cards, seed=0):
+    rng = random.Random(seed)
+    templates = [card for arkhamset in load_example_sets()
+                 for card in arkhamset['cards']]
+    cards = []
+    for i in range(num_cards):
+        card = copy.deepcopy(rng.choice(templates))
+        card['id'] = make_uuid(rng)
+        card['number'] = str(i + 1)
+        for side in ('front', 'back'):
+            if side in card:
+                card[side]['image_url'] = (
+                    'https://example.com/{}/{}.jpg'.format(card['id'], side))
+        if 'encounter_set' in card:
+            card['encounter_set'] = 'Encounter Set {}'.format(i // 20)
+        cards.append(card)
+    return {'id': make_uuid(rng), 'name': 'Synthetic {}'.format(num_cards),
+            'type': 'Other', 'cards': cards}
+
+
+# Scenarios drawing on arkhamset, one per 100 cards, each with two encounter
+# sets and five encounter cards given only by id.
+def make_synthetic_scenarios(arkhamset, seed=0):
+    rng = random.Random(seed)
+    encounter_cards = [card for card in arkhamset['cards']
+                       if 'encounter_set' in card]
+    encounter_sets = sorted({card['encounter_set'] for card in encounter_cards})
+    scenarios = []
+    for i in range(max(1, len(arkhamset['cards']) // 100)):
+        scenario = {
+            'number': str(i + 1), 'name': 'Scenario {}'.format(i + 1),
+            'campaign': 'Synthetic', 'campaign_code': 'SYN',
+            'Encounter': [{'name': '', 'encounter_set': name, 'source': ''}
+                          for name in rng.sample(encounter_sets, 2)],
+            'Setup': [{'id': card['id'], 'name': '', 'source': ''}
+                      for card in rng.sample(encounter_cards, 5)],
+        }
+        scenarios.append(scenario)
+    return scenarios
+
+
+#
+# indent
+#
+
+
+# The original recursive prettyprinter from
+# http://effbot.org/zone/element-lib.htm#prettyprint, kept as a reference for
+# the iterative octgn_package.indent.
+def indent_recursive(elem, level=0):
+    i = "\n" + level*"  "
+    if len(elem):
+        if not elem.text or not elem.text.strip():
+            elem.text = i + "  "
+        if not elem.tail or not elem.tail.strip():
+            elem.tail = i
+        for elem in elem:
+            indent_recursive(elem, level+1)
+        if not elem.tail or not elem.tail.strip():
+            elem.tail = i
+    else:
+        if level and (not elem.tail or not elem.tail.strip()):
+            elem.tail = i
+
+
+def make_deep_tree(depth):
+    root = ET.Element('node')
+    elem = root
+    for _ in range(depth):
+        elem = ET.SubElement(elem, 'node')
+    return root
+
+
+def benchmark_indent(repeat, num_cards):
+    roots = [ET.parse(path).getroot() for path in get_example_set_paths()]
+    num_elements = sum(1 for root in roots for _ in root.iter())
+
+    def indent_all(indent_function):
+        def run(copies):
+            for root in copies:
+                indent_function(root)
+        return run
+
+    def setup():
+        return ([copy.deepcopy(root) for root in roots],)
+
+    for name, function in [('recursive', indent_recursive),
+                           ('iterative', octgn_package.indent)]:
+        seconds = time_function(indent_all(function), repeat, setup)
+        print_result('indent', name, seconds, num_elements, 'elements')
+
+    for root in roots:
+        expected, actual = copy.deepcopy(root), copy.deepcopy(root)
+        indent_recursive(expected)
+        octgn_package.indent(actual)
+        if ET.tostring(expected) != ET.tostring(actual):
+            print('indent: output differs from the recursive version!')
+
+    deep_root = make_deep_tree(sys.getrecursionlimit() * 2)
+    try:
+        indent_recursive(copy.deepcopy(deep_root))
+        print('indent: recursive version handled a deep tree')
+    except RecursionError:
+        print('indent: recursive version hit the recursion limit on a deep tree')
+    octgn_package.indent(deep_root)
+
+
+#
+# format_text_for_octgn
+#
+
+
+# The original symbol translation, one str.replace per symbol.
+def format_text_for_octgn_by_replace(text):
+    for k, v in octgn_package.octgn_symbol_map.items():
+        text = text.replace(k, v)
+    return text
+
+
+# All text that could contain symbols from the cards in the example sets. The
+# example sets are already in OCTGN format, so symbols are turned back into
+# the [Symbol] form used in our spreadsheets.
+def get_example_card_text():
+    unformat = {}
+    for k, v in octgn_package.octgn_symbol_map.items():
+        if k and v not in unformat:
+            unformat[v] = k
+    fields = set(arkham_common.side_data_fields_with_possible_symbols)
+
+    texts = []
+    for path in get_example_set_paths():
+        for prop in ET.parse(path).getroot().iter('property'):
+            if prop.attrib.get('name') in fields:
+                text = prop.attrib.get('value', '')
+                texts.append(''.join(unformat.get(c, c) for c in text))
+    return texts
+
+
+def benchmark_symbols(repeat, num_cards):
+    texts = get_example_card_text()
+    num_chars = sum(len(text) for text in texts)
+
+    for name, function in [('str.replace', format_text_for_octgn_by_replace),
+                           ('single pass', octgn_package.format_text_for_octgn)]:
+        seconds = time_function(lambda: [function(t) for t in texts], repeat)
+        print_result('symbols', name, seconds, num_chars, 'chars')
+
+    for text in texts:
+        if (format_text_for_octgn_by_replace(text)
+                != octgn_package.format_text_for_octgn(text)):
+            print('symbols: output differs for {!r}'.format(text))
+
+
+#
+# card_number_sort_key
+#
+
+
+# The original sort key, which parses the number every time it's called and
+# only handles plain numbers.
+def card_number_sort_key_by_regex(card):
+    m = re.match('^(\\d+)([ab]?)$', card.get('number', '999'))
+    if not m:
+        raise ValueError
+    return 100*int(m.group(1))
+
+
+# A catalog of num_cards cards with numbers in random order. Unless
+# numeric_only is set, some numbers have promo suffixes, a/b faces or aren't
+# numbers at all.
+def make_synthetic_cards(num_cards, numeric_only=False, seed=0):
+    rng = random.Random(seed)
+    cards = []
+    for i in range(num_cards):
+        number = str(rng.randrange(1, 400))
+        if not numeric_only:
+            kind = rng.random()
+            if kind < 0.05:
+                number += rng.choice('ab')
+            elif kind < 0.08:
+                number += 'p'
+            elif kind < 0.1:
+                number = 'P-{}'.format(number)
+        cards.append({'number': number, 'front': {'name': 'Card {}'.format(i),
+                                                  'data': {}}})
+    return cards
+
+
+def benchmark_sort(repeat, num_cards):
+    numeric = make_synthetic_cards(num_cards, numeric_only=True)
+    mixed = make_synthetic_cards(num_cards)
+    typed = [arkham_common.Card.from_dict(card) for card in mixed]
+
+    def sort_cards(cards, key):
+        return lambda: sorted(cards, key=key)
+
+    def cold_cache():
+        arkham_common.get_card_number_key.cache_clear()
+        return ()
+
+    seconds = time_function(
+        sort_cards(numeric, card_number_sort_key_by_regex), repeat)
+    print_result('sort', 'regex per card', seconds, num_cards, 'cards')
+    seconds = time_function(
+        sort_cards(numeric, arkham_common.card_number_sort_key), repeat,
+        cold_cache)
+    print_result('sort', 'parsed keys, cold', seconds, num_cards, 'cards')
+    seconds = time_function(
+        sort_cards(numeric, arkham_common.card_number_sort_key), repeat)
+    print_result('sort', 'parsed keys, warm', seconds, num_cards, 'cards')
+    seconds = time_function(
+        sort_cards(mixed, arkham_common.card_number_sort_key), repeat)
+    print_result('sort', 'mixed numbers', seconds, num_cards, 'cards')
+    seconds = time_function(
+        sort_cards(typed, arkham_common.card_number_sort_key), repeat)
+    print_result('sort', 'typed cards', seconds, num_cards, 'cards')
+
+    expected = sorted(numeric, key=card_number_sort_key_by_regex)
+    if expected != sorted(numeric, key=arkham_common.card_number_sort_key):
+        print('sort: order differs from the regex version!')
+
+
+#
+# set files
+#
+
+
+def benchmark_set_files(repeat, num_cards):
+    arkhamset = {'id': 'synthetic', 'name': 'Synthetic', 'type': 'Other',
+                 'cards': make_synthetic_cards(num_cards)}
+    for card in arkhamset['cards']:
+        card['front']['data'].update(
+            {'Type': 'Asset', 'Class': 'Seeker', 'Cost': '2',
+             'Text': '[Action] Investigate. You get +2 [Intellect] for this'
+                     ' investigation.'})
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for file_format in ['json', 'json.gz', 'binary']:
+            path = os.path.join(
+                tmp_dir, 'set' + set_files.get_extension(file_format))
+            seconds = time_function(
+                lambda: arkham_common.create_set_file(arkhamset, path), repeat)
+            print_result('set_files', 'write ' + file_format, seconds,
+                         num_cards, 'cards')
+            seconds = time_function(
+                lambda: arkham_common.load_set(path), repeat)
+            print_result('set_files', 'read ' + file_format, seconds,
+                         num_cards, 'cards')
+            seconds = time_function(
+                lambda: arkham_common.load_set_info(path), repeat)
+            print_result('set_files', 'read info ' + file_format, seconds)
+            print('{:<12} {:<24} {:10,} bytes'.format(
+                'set_files', file_format, os.path.getsize(path)))
+            if arkham_common.load_set(path) != arkhamset:
+                print('set_files: {} file differs after reading it back!'
+                      .format(file_format))
+
+
+#
+# set XML
+#
+
+
+def benchmark_set_xml(repeat, num_cards):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, 'set.xml')
+
+        def write_tree(arkhamsets):
+            for arkhamset in arkhamsets:
+                ET.ElementTree(octgn_package.create_set_xml(arkhamset)).write(
+                    path, encoding='UTF-8', xml_declaration=True)
+
+        def write_streaming(arkhamsets):
+            for arkhamset in arkhamsets:
+                octgn_package.write_set_xml(arkhamset, path)
+
+        for label, arkhamsets in [('examples', load_example_sets()),
+                                  ('synthetic', [make_synthetic_set(num_cards)])]:
+            count = sum(len(s['cards']) for s in arkhamsets)
+            setup = lambda: (copy.deepcopy(arkhamsets),)
+            seconds = time_function(write_tree, repeat, setup)
+            print_result('set_xml', 'tree ' + label, seconds, count, 'cards')
+            seconds = time_function(write_streaming, repeat, setup)
+            print_result('set_xml', 'streaming ' + label, seconds, count,
+                         'cards')
+
+
+def benchmark_format_card(repeat, num_cards):
+    cards = make_synthetic_set(num_cards)['cards']
+
+    def format_cards(cards):
+        for card in cards:
+            octgn_package.format_card_for_octgn(card)
+
+    seconds = time_function(
+        format_cards, repeat, lambda: (copy.deepcopy(cards),))
+    print_result('format_card', 'synthetic', seconds, num_cards, 'cards')
+
+
+#
+# parsing and indexing set XML files
+#
+
+
+def benchmark_index(repeat, num_cards):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        synthetic_path = os.path.join(tmp_dir, 'set.xml')
+        octgn_package.write_set_xml(
+            make_synthetic_set(num_cards), synthetic_path)
+
+        for label, paths in [('examples', get_example_set_paths()),
+                             ('synthetic', [synthetic_path])]:
+            roots = [ET.parse(path).getroot() for path in paths]
+            count = sum(len(root.findall('./cards/card')) for root in roots)
+            seconds = time_function(
+                lambda: [ET.parse(path) for path in paths], repeat)
+            print_result('index', 'parse ' + label, seconds, count, 'cards')
+            seconds = time_function(
+                lambda: [octgn_package.SetIndex(root) for root in roots],
+                repeat)
+            print_result('index', 'index ' + label, seconds, count, 'cards')
+
+
+#
+# scenario XML
+#
+
+
+def benchmark_scenario_xml(repeat, num_cards):
+    arkhamset = make_synthetic_set(num_cards)
+    scenarios = make_synthetic_scenarios(arkhamset)
+    old_dir = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        try:
+            set_dir = os.path.join('Sets', arkhamset['id'])
+            os.makedirs(set_dir)
+            octgn_package.write_set_xml(
+                copy.deepcopy(arkhamset), os.path.join(set_dir, 'set.xml'))
+
+            def create_scenarios(scenarios):
+                for scenario in scenarios:
+                    octgn_package.create_scenario_xml(
+                        scenario, arkhamset['id'])
+
+            def cold_cache():
+                octgn_package.invalidate_source_set()
+                return (copy.deepcopy(scenarios[:1]),)
+
+            seconds = time_function(create_scenarios, repeat, cold_cache)
+            print_result('scenario', 'first, cold cache', seconds, 1,
+                         'scenarios')
+            create_scenarios(copy.deepcopy(scenarios[:1]))
+            seconds = time_function(
+                create_scenarios, repeat, lambda: (copy.deepcopy(scenarios),))
+            print_result('scenario', 'all, warm cache', seconds,
+                         len(scenarios), 'scenarios')
+        finally:
+            octgn_package.invalidate_source_set()
+            os.chdir(old_dir)
+
+
+#
+# spreadsheet rows
+#
+
+
+# Rows of a Scenarios sheet for the scenarios guessed from arkhamset, split
+# into scenarios of 50 rows.
+def make_scenario_rows(arkhamset):
+    rows = []
+    guess_rows = arkham_sheets.make_scenario_sheet_guess_data(
+        arkhamset)['values']
+    for i, row in enumerate(guess_rows):
+        number = i // 50 + 1
+        rows.append(['SYN', 'Synthetic', str(number),
+                     'Scenario {}'.format(number)] + row)
+    return rows
+
+
+def benchmark_sheets(repeat, num_cards):
+    arkhamset = make_synthetic_set(num_cards)
+    cards_rows = arkham_sheets.make_cards_data(
+        copy.deepcopy(arkhamset))['values']
+    scenario_rows = make_scenario_rows(arkhamset)
+
+    seconds = time_function(
+        arkham_sheets.make_cards_data, repeat,
+        lambda: (copy.deepcopy(arkhamset),))
+    print_result('sheets', 'write cards rows', seconds, num_cards, 'cards')
+    seconds = time_function(
+        arkham_sheets.read_cards_sheet, repeat, lambda: (cards_rows,))
+    print_result('sheets', 'read cards rows', seconds, len(cards_rows),
+                 'rows')
+    seconds = time_function(
+        arkham_sheets.read_scenarios_sheet, repeat,
+        lambda: (copy.deepcopy(scenario_rows),))
+    print_result('sheets', 'read scenario rows', seconds,
+                 len(scenario_rows), 'rows')
+
+    if len(arkham_sheets.read_cards_sheet(cards_rows)) != num_cards:
+        print('sheets: wrong number of cards read back!')
+
+
+#
+# parsing cardgamedb pages
+#
+
+
+card_page_url_re = re.compile(r'/arkham-horror-the-card-game/_/.*-r\d+$')
+
+
+# Card pages recorded in the web page cache by cardgamedb_scraper.py, if any.
+def load_recorded_card_pages(cache_dir=http_cache.default_cache_dir):
+    if not os.path.isdir(cache_dir):
+        return []
+    cache = http_cache.HttpCache(cache_dir)
+    pages = []
+    for url, entry in sorted(cache.entries.items()):
+        if card_page_url_re.search(url):
+            content = cache.read_blob(entry['hash'])
+            if content is not None:
+                pages.append(content.decode(entry.get('encoding') or 'utf-8',
+                                            errors='replace'))
+    return pages
+
+
+# Pages in cardgamedb's layout for cards of the example sets, wrapped in
+# navigation, sidebars and scripts like those of the real site, which make up
+# most of each page.
+def make_synthetic_card_pages():
+    nav = ''.join('<li class="nav"><a href="/forum/{0}" title="Forum {0}">'
+                  'Forum {0}</a></li>'.format(i) for i in range(150))
+    sidebar = ''.join('<div class="post"><div class="author"><a href="/u/{0}">'
+                      'user{0}</a></div><div class="body"><p>Post {0} about'
+                      ' this card.</p></div></div>'.format(i)
+                      for i in range(40))
+    script = '<script>var ipb = {};' + ' ipb.x = 1;' * 500 + '</script>'
+    pages = []
+    for arkhamset in load_example_sets():
+        for i, card in enumerate(arkhamset['cards']):
+            page = fake_services.render_card_page(
+                card, str(i + 1), ['http://example.com/{}.jpg'.format(i)])
+            head, body = page.split('<body>', 1)
+            pages.append(
+                '{}<head>{}</head><body><div id="wrapper"><ul>{}</ul>'
+                '<div id="content">{}<div id="comments">{}</div></div></div>'
+                .format(head, script, nav, body, sidebar))
+    return pages
+
+
+def parse_card_page_fully(page, parser):
+    soup = BeautifulSoup(page, parser)
+    return (soup.h1.string.strip(),
+            soup.find('div', 'cardText').find_all('div'),
+            soup.table.find_all('img'))
+
+
+def benchmark_parse(repeat, num_cards):
+    parsers = ['html.parser']
+    if cardgamedb_scraper.lxml is not None:
+        parsers.append('lxml')
+    else:
+        print('parse: lxml is not installed, only html.parser is timed')
+
+    for label, pages in [('recorded', load_recorded_card_pages()),
+                         ('synthetic', make_synthetic_card_pages())]:
+        if not pages:
+            continue
+        for parser in parsers:
+            seconds = time_function(
+                lambda: [parse_card_page_fully(p, parser) for p in pages],
+                repeat)
+            print_result('parse', '{} full {}'.format(parser, label),
+                         seconds, len(pages), 'pages')
+            seconds = time_function(
+                lambda: [cardgamedb_scraper.parse_card_page(p, parser)
+                         for p in pages], repeat)
+            print_result('parse', '{} strained {}'.format(parser, label),
+                         seconds, len(pages), 'pages')
+
+        for page in pages:
+            full = parse_card_page_fully(page, 'html.parser')
+            for parser in parsers:
+                if cardgamedb_scraper.parse_card_page(page, parser) != full:
+                    print('parse: {} parsed a {} page differently!'.format(
+                        parser, label))
+                    break
+
+
+benchmarks = {
+    'indent': benchmark_indent,
+    'symbols': benchmark_symbols,
+    'sort': benchmark_sort,
+    'set_files': benchmark_set_files,
+    'set_xml': benchmark_set_xml,
+    'format_card': benchmark_format_card,
+    'index': benchmark_index,
+    'scenario': benchmark_scenario_xml,
+    'sheets': benchmark_sheets,
+    'parse': benchmark_parse,
+}
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=package_dir, check=True,
+            capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(path, args):
+    report = {
+        'commit': get_git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'repeat': args.repeat,
+        'num_cards': args.cards,
+        'results': results,
+    }
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+    print('Wrote results to {}'.format(path))
+
+
+# Show how long each result took relative to the same result in a saved file.
+def print_comparison(path):
+    with open(path, 'r') as f:
+        old_report = json.load(f)
+    old_results = {(r['benchmark'], r['variant']): r['seconds']
+                   for r in old_report['results']}
+    print('compared to {} ({}):'.format(path, old_report.get('commit')))
+    for r in results:
+        old_seconds = old_results.get((r['benchmark'], r['variant']))
+        if old_seconds:
+            print('{:<12} {:<24} {:10.3f} ms -> {:10.3f} ms  {:+6.1f}%'.format(
+                r['benchmark'], r['variant'], old_seconds * 1000,
+                r['seconds'] * 1000,
+                (r['seconds'] - old_seconds) / old_seconds * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run benchmarks.')
+    parser.add_argument('names', nargs='*', choices=[[]] + list(benchmarks),
+        help='benchmarks to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=5,
+        help='number of times to run each benchmark; the best time is shown')
+    parser.add_argument('--cards', type=int, default=default_num_cards,
+        help='number of cards in synthetic catalogs')
+    parser.add_argument('--json', metavar='PATH',
+        help='save the results to PATH as JSON')
+    parser.add_argument('--compare', metavar='PATH',
+        help='compare the results to ones saved earlier with --json')
+    args = parser.parse_args()
+
+    for name in args.names or benchmarks:
+        benchmarks[name](args.repeat, args.cards)
+
+    if args.json:
+        save_results(args.json, args)
+    if args.compare:
+        print_comparison(args.compare)
+
+
+if __name__ == '__main__':
+    main()
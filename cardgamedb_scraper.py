@@ -6,11 +6,27 @@
 # cardgamedb urls look like this:
 # http://www.cardgamedb.com/index.php/arkhamhorror/arkham-horror-the-card-game/_/the-path-to-carcosa-cycle/the-pallid-mask/
 
+import os
 import sys
 import re
-import requests
+import copy
+import json
+import hashlib
+import argparse
+import collections
+import threading
+from concurrent.futures import ThreadPoolExecutor
 import arkham_common
-from bs4 import BeautifulSoup
+import http_fetch
+import http_cache
+import set_files
+import profiling
+from bs4 import BeautifulSoup, SoupStrainer
+
+try:
+    import lxml
+except ImportError:     # html.parser is used instead
+    lxml = None
 
 class SetScrapingError(Exception):
     """Base class for exceptions in this module."""
@@ -18,6 +34,11 @@ class SetScrapingError(Exception):
 
 suffix_1000_per_page = '?per_page=1000'
 
+# Card pages are fetched in parallel by this many threads by default. Keep this
+# and the per-host request rate modest so we don't hammer cardgamedb.
+default_workers = 8
+default_requests_per_second = 5
+
 # translate some symbols that are represented strangely on the cardgamedb set page
 # into human-readable symbols
 cardgamedb_symbol_map = {
@@ -25,31 +46,98 @@ cardgamedb_symbol_map = {
     '[per_investigator]': '[Investigators]',
 }
 
+translate_cardgamedb_symbols = arkham_common.make_symbol_translator(
+    cardgamedb_symbol_map)
+
 def to_sheets_format(text):
-    for k, v in cardgamedb_symbol_map.items():
-        text.replace(k, v)
-    return text
+    return translate_cardgamedb_symbols(text)
+
+
+# Pages are parsed with lxml if it's installed, which is several times faster
+# than the pure-Python html.parser. Either can be chosen with --parser.
+html_parsers = ['lxml', 'html.parser']
+default_html_parser = 'lxml' if lxml is not None else 'html.parser'
+html_parser = default_html_parser
+
+
+# Only the parts of a page we read are built into the tree: the set or card
+# name, the cardText divs and (on card pages) the table of card images.
+# Everything else is skipped by the parser, which saves most of the parsing
+# time for cardgamedb's large pages.
+class PagePartsStrainer(SoupStrainer):
+    def __init__(self, tag_names, classes):
+        super().__init__()
+        self.tag_names = tag_names
+        self.classes = classes
+
+    def wants_tag(self, name, attrs):
+        if name in self.tag_names:
+            return True
+        classes = (attrs or {}).get('class') or ''
+        if not isinstance(classes, str):
+            classes = ' '.join(classes)
+        return any(c in self.classes for c in classes.split())
 
+    # used by Beautiful Soup 4.13 and later
+    def allow_tag_creation(self, nsprefix, name, attrs):
+        return self.wants_tag(name, attrs)
 
-def get_card_raw_data(url):
-    page = requests.get(url).text
-    soup = BeautifulSoup(page, 'html.parser')
+    # used by earlier versions
+    def search_tag(self, markup_name=None, markup_attrs={}):
+        return self.wants_tag(markup_name, markup_attrs)
 
+
+card_page_strainer = PagePartsStrainer({'h1', 'table'}, {'cardText'})
+set_page_strainer = PagePartsStrainer({'h1'}, {'cardText'})
+
+
+# returns the card name, the divs in its cardText and its images
+def parse_card_page(page, parser=None):
+    soup = BeautifulSoup(page, parser or html_parser,
+                         parse_only=card_page_strainer)
     name = soup.h1.string.strip()
     fields = soup.find('div', 'cardText').find_all('div')
     imgs = soup.table.find_all('img')
-
     return name, fields, imgs
 
 
-def get_card(url):
-    name, fields, imgs = get_card_raw_data(url)
+# returns the set name and the URLs of its card pages
+def parse_set_page(page, parser=None):
+    soup = BeautifulSoup(page, parser or html_parser,
+                         parse_only=set_page_strainer)
+    setname = soup.h1.string.strip()
+    links = [cardText.find('a') for cardText in soup.find_all('div', 'cardText')]
+    return setname, [l['href'].strip() for l in links]
+
+
+# A hash of the parts of a card page we read. The rest of the page (session
+# tokens, who's online, timestamps) changes on every request, so hashing the
+# whole page would make every card look changed.
+def get_page_hash(name, fields, imgs):
+    content = [name, [[f.get('class'), f.text] for f in fields],
+               [img.get('src') for img in imgs]]
+    return hashlib.sha256(json.dumps(content).encode('utf-8')).hexdigest()
+
+
+# returns the card name, fields and images, and the hash of them
+def get_card_raw_data(url, rate_limiter=None, session=None, cache=None):
+    page = http_fetch.get_page(url, rate_limiter, session, cache)
+    with profiling.timer('parse_card_page'):
+        name, fields, imgs = parse_card_page(page)
+    return name, fields, imgs, get_page_hash(name, fields, imgs)
+
+
+def get_card(url, rate_limiter=None, session=None, cache=None):
+    name, fields, imgs, page_hash = get_card_raw_data(
+        url, rate_limiter, session, cache)
 
     card = {
         'front': {  'name': name,
                     'image_url': imgs[0]['src'],
                     'data': {},
-        }
+        },
+        'source_url': url,
+        'page_hash': page_hash,
     }
 
     if len(imgs) > 1:
@@ -73,7 +161,7 @@ def get_card(url):
                 elif field == 'Encounter Set':
                     card['encounter_set'] = value
                 elif field == 'Clue Threshold':
-                    card['front']['clues'] = to_sheets_format(value)
+                    card['front']['data']['Clues'] = to_sheets_format(value)
                 elif field == 'Illustrator':    # we don't need this field
                     continue
                 else:   # assume this is a normal field that goes in side data
@@ -108,36 +196,334 @@ def get_card(url):
     return card
 
 
-def scrape_set_from_url(url):
-    page = requests.get(url + suffix_1000_per_page).text
-    soup = BeautifulSoup(page, 'html.parser')
-    setname = soup.h1.string.strip()
+# A record of the cards scraped so far from a set, so that a scrape that stops
+# part way through (because a page timed out or couldn't be parsed, or the
+# program was interrupted) can be resumed without fetching those cards again.
+#
+# The journal is a file of JSON lines: first {"set_url": url}, then
+# {"url": card_url, "card": card} for each card as soon as it's scraped. Lines
+# are only ever appended, so a crash can at worst leave the last line
+# incomplete, and that line is ignored when the journal is read back.
+class ScrapeJournal:
+    def __init__(self, path, set_url):
+        self.path = path
+        self.cards = {}
+        self.lock = threading.Lock()
+
+        if os.path.exists(path):
+            records = []
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:  # only expected for an unfinished line
+                        break
+            if records and records[0].get('set_url') != set_url:
+                raise SetScrapingError(
+                    'Journal {} is for set {}, not {}'.format(
+                        path, records[0].get('set_url'), set_url))
+            for record in records[1:]:
+                self.cards[record['url']] = record['card']
+            # Write back only the complete records, each ending in a newline,
+            # so new records never run on from a cut off last line.
+            with open(path, 'w', encoding='utf-8') as f:
+                f.writelines(json.dumps(record) + '\n' for record in records)
+
+        self.file = open(path, 'a', encoding='utf-8')
+        if self.file.tell() == 0:
+            self.write({'set_url': set_url})
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def write(self, record):
+        with self.lock:
+            self.file.write(json.dumps(record) + '\n')
+            self.file.flush()
+
+    def add(self, card_url, card):
+        self.cards[card_url] = card
+        self.write({'url': card_url, 'card': card})
+
+    def close(self):
+        self.file.close()
+
+    # Delete the journal once the set it was for has been saved.
+    def remove(self):
+        self.close()
+        os.remove(self.path)
+
+
+def get_default_journal_path(url):
+    name = url.rstrip('/').rsplit('/', 1)[-1] or 'set'
+    return name + '.journal'
+
+
+# Fetch and parse the cards at card_urls, returning them in the same order.
+# Up to `workers` pages are fetched at once. See scrape_set_from_url for
+# `journal` and `errors`; a card that fails to scrape is returned as None when
+# errors are being collected.
+def scrape_cards(card_urls, rate_limiter, session, cache=None,
+                 workers=default_workers, journal=None, errors=None):
+    journaled = journal.cards if journal is not None else {}
+    if journaled:
+        print("resuming: {} of {} cards already scraped".format(
+            sum(1 for u in card_urls if u in journaled), len(card_urls)))
+
+    # held while printing too, so lines from different threads don't mix
+    lock = threading.Lock()
+
+    def load_card(card_url):
+        if card_url in journaled:
+            return journaled[card_url]
+        try:
+            c = get_card(card_url, rate_limiter, session, cache)
+        except Exception as e:
+            if errors is None:
+                raise
+            with lock:
+                print("failed to load {}: {}".format(card_url, e))
+                errors.append((card_url, e))
+            return None
+        if journal is not None:
+            journal.add(card_url, c)
+        with lock:
+            print("loaded {}".format(card_url))
+        return c
+
+    executor = ThreadPoolExecutor(max_workers=max(1, workers))
+    try:
+        cards = list(executor.map(load_card, card_urls))
+    except:
+        executor.shutdown(wait=True, cancel_futures=True)
+        raise
+    executor.shutdown()
+    profiling.count('cards.scraped', sum(1 for c in cards if c is not None))
+    if errors:
+        # report failures in set page order, not the order they happened in
+        order = {u: i for i, u in enumerate(card_urls)}
+        errors.sort(key=lambda error: order.get(error[0], len(order)))
+    return cards
+
+
+# returns the set name and its card URLs
+def get_set_page(url, rate_limiter, session, cache=None):
+    page = http_fetch.get_page(
+        url + suffix_1000_per_page, rate_limiter, session, cache)
+    return parse_set_page(page)
+
+
+# Fetch and parse every card page linked from the set page. Up to `workers`
+# pages are fetched at once, limited to `rate` requests per second per host.
+# Cards are returned in the order they're listed on the set page. Pass an
+# http_cache.HttpCache to avoid downloading unchanged pages again.
+#
+# If a ScrapeJournal is given, cards already in it aren't fetched again, and
+# every card scraped is added to it. If any card fails to scrape, the exception
+# for the first such card is raised, unless a list is passed as `errors`: then
+# (card_url, exception) is appended to it for each failing card and the set is
+# returned without those cards.
+@profiling.timer('scrape')
+def scrape_set_from_url(url, workers=default_workers,
+                        rate=default_requests_per_second, cache=None,
+                        session=None, journal=None, errors=None):
+    rate_limiter = http_fetch.RateLimiter(rate)
+    if session is None:
+        session = http_fetch.create_session(pool_size=max(1, workers))
+    setname, card_urls = get_set_page(url, rate_limiter, session, cache)
     print("scraping set\'{}\' from {}".format(setname, url))
 
-    cards = []
-    links = [cardText.find('a') for cardText in soup.find_all('div', 'cardText')]
-    for l in links:
-        card_url = l['href'].strip()
-        print("loading {}...".format(card_url))
-        c = get_card(card_url)
-        cards.append(c)
-        print("\t...done.")
+    cards = scrape_cards(card_urls, rate_limiter, session, cache, workers,
+                         journal, errors)
 
     # TODO: try to guess the type based on available info
 
-    return {'name': setname, 'cards': cards}
+    return {'name': setname, 'cards': [c for c in cards if c is not None]}
+
+
+# Update an existing card with a new scrape of its page. If the page hasn't
+# changed the card is left as it is. Otherwise the scraped fields replace the
+# old ones, keeping the card's id and any fields cardgamedb doesn't give (such
+# as those entered by hand in the spreadsheet). A back the page no longer has is
+# removed.
+def merge_card(card, scraped):
+    if card.get('page_hash') == scraped['page_hash']:
+        return card
+    merged = copy.deepcopy(card)
+    for k, v in scraped.items():
+        if k in ('front', 'back') and k in merged:
+            side = merged[k]
+            side['name'] = v['name']
+            side['image_url'] = v['image_url']
+            side['data'] = dict(side.get('data', {}), **v['data'])
+        else:
+            merged[k] = copy.deepcopy(v)
+    if 'back' in merged and 'back' not in scraped:
+        del merged['back']
+    return merged
+
+
+# Bring a set scraped earlier up to date with its set page, fetching only the
+# cards linked from the page that aren't in the set yet, so updating a set
+# after a new pack is previewed takes a request for the set page and one for
+# each new card. With recheck=True every card page is fetched again (cheaply,
+# with conditional requests, if `cache` is given), and cards whose page has
+# changed are updated with merge_card.
+#
+# Cards are matched to their pages by 'source_url'. Cards from sets scraped
+# before that was recorded are matched by number and name, which costs one full
+# scrape the first time. The set keeps its id, type and scenarios, and its
+# cards keep their ids; cards the set page no longer links to (or that were
+# added by hand) are kept after the others. Returns the updated set and the
+# number of cards that were added or changed.
+@profiling.timer('update')
+def update_set_from_url(arkhamset, url, workers=default_workers,
+                        rate=default_requests_per_second, cache=None,
+                        session=None, journal=None, errors=None,
+                        recheck=False):
+    rate_limiter = http_fetch.RateLimiter(rate)
+    if session is None:
+        session = http_fetch.create_session(pool_size=max(1, workers))
+    setname, card_urls = get_set_page(url, rate_limiter, session, cache)
+
+    old_cards = arkhamset['cards']
+    by_url = {c['source_url']: c for c in old_cards if c.get('source_url')}
+    by_number_and_name = collections.defaultdict(list)
+    for c in old_cards:
+        if not c.get('source_url'):
+            by_number_and_name[c.get('number'), c['front']['name']].append(c)
+    to_fetch = [u for u in card_urls if recheck or u not in by_url]
+    print("updating set \'{}\' from {}: fetching {} of {} cards".format(
+        setname, url, len(to_fetch), len(card_urls)))
+
+    scraped = dict(zip(to_fetch, scrape_cards(
+        to_fetch, rate_limiter, session, cache, workers, journal, errors)))
+
+    cards = []
+    used = set()    # id()s of the old cards that are in cards
+    num_changed = 0
+    for card_url in card_urls:
+        card = by_url.get(card_url)
+        new_card = scraped.get(card_url)
+        if card is None and new_card is not None:
+            matches = by_number_and_name.get(
+                (new_card.get('number'), new_card['front']['name']))
+            if matches:
+                card = matches.pop(0)
+        if card is not None:
+            used.add(id(card))
+        if new_card is None:    # not fetched, or failed to scrape
+            if card is not None:
+                cards.append(card)
+            continue
+        merged = merge_card(card, new_card) if card is not None else new_card
+        if merged is not card:
+            num_changed += 1
+        cards.append(merged)
+
+    cards.extend(c for c in old_cards if id(c) not in used)
+    profiling.count('cards.updated', num_changed)
+
+    return dict(arkhamset, cards=cards), num_changed
 
 
 def main():
-    if len(sys.argv) < 2:
-        raise ValueError("Command line argument needed: cardgamedb URL of set")
+    parser = argparse.ArgumentParser(
+        description='Scrape an Arkham Horror LCG set from cardgamedb.')
+    parser.add_argument('url', help='cardgamedb URL of set')
+    parser.add_argument('--workers', type=int, default=default_workers,
+        help='number of card pages to fetch at once')
+    parser.add_argument('--rate', type=float,
+        default=default_requests_per_second,
+        help='max requests per second to cardgamedb (0 for no limit)')
+    parser.add_argument('--cache-dir', default=http_cache.default_cache_dir,
+        help='directory for cached web pages')
+    parser.add_argument('--no-cache', action='store_true',
+        help="don't use or update the web page cache")
+    parser.add_argument('--format', default=None,
+        choices=sorted(set_files.file_extensions.values()),
+        help='format of the set file to write (default: json). Not used with'
+             ' --update, which keeps the format of SET_FILE')
+    parser.add_argument('--parser', default=default_html_parser,
+        choices=html_parsers, help='HTML parser to use (default: %(default)s)')
+    parser.add_argument('--journal', metavar='PATH',
+        help='file recording the cards scraped so far, which a rerun resumes'
+             ' from (default: named after the last part of the URL)')
+    parser.add_argument('--no-journal', action='store_true',
+        help="don't record or resume from a journal")
+    parser.add_argument('--keep-going', action='store_true',
+        help='skip cards that fail to scrape, report them at the end and'
+             ' write the set without them')
+    parser.add_argument('--update', metavar='SET_FILE',
+        help='only fetch the cards that are new since SET_FILE was scraped,'
+             ' and write the updated set back to it')
+    parser.add_argument('--recheck', action='store_true',
+        help='with --update, also fetch the cards already in the set again'
+             ' and update those whose page has changed')
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
+    if args.recheck and not args.update:
+        parser.error('--recheck needs --update')
+    if args.format and args.update:
+        parser.error('--update writes SET_FILE in its own format;'
+                     ' --format can\'t be used with it')
+
+    global html_parser
+    html_parser = args.parser
+
+    errors = [] if args.keep_going else None
+    journal = None
+    if not args.no_journal:
+        journal = ScrapeJournal(
+            args.journal or get_default_journal_path(args.url), args.url)
 
-    url = sys.argv[1]
-    arkhamset = scrape_set_from_url(url)
+    def scrape(cache=None):
+        if args.update:
+            arkhamset, num_changed = update_set_from_url(
+                arkham_common.load_set(args.update), args.url, args.workers,
+                args.rate, cache, journal=journal, errors=errors,
+                recheck=args.recheck)
+            print("{} cards added or changed".format(num_changed))
+            return arkhamset
+        return scrape_set_from_url(args.url, args.workers, args.rate, cache,
+                                   journal=journal, errors=errors)
 
-    path = arkham_common.create_set_file(arkhamset)
+    with profiling.session(args.profile, args.cprofile_dir):
+        try:
+            if args.no_cache:
+                arkhamset = scrape()
+            else:
+                with http_cache.HttpCache(args.cache_dir) as cache:
+                    arkhamset = scrape(cache)
+                print(cache.format_stats())
+        except:
+            if journal is not None:
+                journal.close()
+                print("Scraped cards were saved to {}; run again to resume"
+                      .format(journal.path))
+            raise
+
+        with profiling.timer('write_set_file'):
+            path = arkham_common.create_set_file(
+                arkhamset, args.update, file_format=args.format or 'json')
     print("Wrote set data to {}".format(path))
 
+    if errors:
+        print("{} cards couldn't be scraped and were left out:".format(
+            len(errors)))
+        for card_url, e in errors:
+            print("  {}: {}".format(card_url, e))
+        if journal is not None:
+            journal.close()
+            print("Run again to retry them; the other cards are saved in {}"
+                  .format(journal.path))
+        sys.exit(1)
+    elif journal is not None:
+        journal.remove()
+
 
 if __name__ == '__main__':
     main()
@@ -3,7 +3,7 @@
 # TODO: add module description
 
 import sys
-from arkham_data import load_set
+from arkham_common import load_set
 from arkham_sheets import create_spreadsheet_for_set
 
 # from json
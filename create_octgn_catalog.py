@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+# Create OCTGN packages for a whole catalog of sets at once.
+#
+# The manifest is a text file listing one set per line, either as the URL of
+# the set's spreadsheet or as the path to a set JSON file. Blank lines and
+# lines starting with '#' are ignored.
+#
+# Sets are built by a pool of worker processes in two phases: first the set XML
+# files of every set are written, then the scenario decks, image packs and
+# archives, since decks can use cards from any other set in the catalog. The
+# user logs in to Google once and the credentials are handed to every worker.
+# A JSON report with the result of each set is written at the end. With
+# --profile it includes the time spent in each phase of building each set and
+# counts of requests, images etc. (see profiling).
+
+import sys
+import json
+import time
+import argparse
+import traceback
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import arkham_common
+import arkham_sheets
+import octgn_build
+import octgn_package
+import profiling
+from create_octgn_package import create_package_archives
+
+
+default_report_path = 'catalog_report.json'
+
+# set up in each worker process by init_worker
+worker_state = {}
+
+
+def read_manifest(path):
+    sources = []
+    with open(path, 'r') as manifest:
+        for line in manifest:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                sources.append(line)
+    return sources
+
+
+def is_spreadsheet_source(source):
+    return '/spreadsheets/d/' in source
+
+
+def init_worker(creds, options):
+    worker_state['creds'] = creds
+    worker_state['options'] = options
+
+
+def get_worker_service(name, build_service):
+    if name not in worker_state:
+        worker_state[name] = build_service(worker_state['creds'])
+    return worker_state[name]
+
+
+# fake_services is only imported when it's used, so real builds don't load it
+def load_fake_sheets(state_path):
+    import fake_services
+    return fake_services.FakeSheetsService.load(state_path)
+
+
+def load_arkhamset(source):
+    if not is_spreadsheet_source(source):
+        return arkham_common.load_set(source, typed=True)
+
+    options = worker_state['options']
+    service = drive_service = None
+    if options['fake_sheets']:
+        service = drive_service = get_worker_service(
+            'fake_sheets',
+            lambda creds: load_fake_sheets(options['fake_sheets']))
+    elif not options['offline']:
+        service = get_worker_service(
+            'sheets', arkham_sheets.get_sheets_api_service)
+        drive_service = get_worker_service(
+            'drive', arkham_sheets.get_drive_api_service)
+    return arkham_sheets.read_set(
+        source, service=service, drive_service=drive_service,
+        snapshot_dir=options['snapshot_dir'], offline=options['offline'])
+
+
+# Run one phase of the build for one set, catching any error so that it can be
+# reported without stopping the rest of the catalog.
+def run_job(phase, source, *args):
+    start = time.perf_counter()
+    result = {'source': source}
+    profiling.reset()
+    try:
+        result.update(phase(source, *args))
+        result['status'] = 'ok'
+    except Exception as e:
+        result['status'] = 'error'
+        result['error'] = '{}: {}'.format(type(e).__name__, e)
+        result['traceback'] = traceback.format_exc()
+    result['seconds'] = time.perf_counter() - start
+    if worker_state['options']['profile']:
+        result['profile'] = profiling.get_report()
+    return result
+
+
+def get_state_dir():
+    if worker_state['options']['incremental']:
+        return octgn_build.default_state_dir
+    return None
+
+
+def build_set_data(source):
+    arkhamset = load_arkhamset(source)
+    set_path = octgn_package.create_set_data(arkhamset, get_state_dir())
+    return {'arkhamset': arkhamset, 'set_path': set_path}
+
+
+def build_set_package(source, arkhamset, set_path):
+    options = worker_state['options']
+    archive_paths = create_package_archives(
+        arkhamset, set_path, get_state_dir(), options['incremental'],
+        options['separate_images'], options['image_quality'])
+    return {'archive_paths': archive_paths}
+
+
+# Parse the sets that scenarios most often draw cards from, so that workers
+# forked from this process start out with them in their source set cache.
+def preload_common_source_sets():
+    for source in octgn_package.campaign_ids.values():
+        try:
+            octgn_package.load_source_set(source)
+        except octgn_package.SetDataError:
+            pass
+
+
+# combine the profiling reports of the two phases of building a set
+def merge_profiles(a, b):
+    merged = {'timings': dict(a['timings']), 'counters': dict(a['counters'])}
+    for name, timing in b['timings'].items():
+        if name in merged['timings']:
+            timing = {
+                'seconds': merged['timings'][name]['seconds'] + timing['seconds'],
+                'calls': merged['timings'][name]['calls'] + timing['calls'],
+            }
+        merged['timings'][name] = timing
+    for name, n in b['counters'].items():
+        merged['counters'][name] = merged['counters'].get(name, 0) + n
+    return merged
+
+
+def build_catalog(sources, workers=None, snapshot_dir=None, offline=False,
+                  incremental=False, separate_images=False,
+                  image_quality=None, profile=False, fake_sheets=None):
+    creds = None
+    if (not offline and not fake_sheets
+            and any(is_spreadsheet_source(s) for s in sources)):
+        creds = arkham_sheets.get_credentials()
+    options = {
+        'snapshot_dir': snapshot_dir,
+        'offline': offline,
+        'incremental': incremental,
+        'separate_images': separate_images,
+        'image_quality': image_quality,
+        'profile': profile,
+        'fake_sheets': fake_sheets,
+    }
+    if multiprocessing.get_start_method() == 'fork':
+        preload_common_source_sets()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(creds, options)) as executor:
+        data_results = list(executor.map(
+            run_job, [build_set_data] * len(sources), sources))
+
+        ok = [i for i, r in enumerate(data_results) if r['status'] == 'ok']
+        package_results = executor.map(
+            run_job, [build_set_package] * len(ok),
+            [sources[i] for i in ok],
+            [data_results[i].pop('arkhamset') for i in ok],
+            [data_results[i]['set_path'] for i in ok])
+
+        for i, r in zip(ok, package_results):
+            data_results[i]['seconds'] += r.pop('seconds')
+            if profile:
+                data_results[i]['profile'] = merge_profiles(
+                    data_results[i]['profile'], r.pop('profile'))
+            data_results[i].update(r)
+
+    return data_results
+
+
+def print_report(results):
+    for r in results:
+        print('{:<6} {:7.1f}s  {}'.format(r['status'], r['seconds'], r['source']))
+        if r['status'] != 'ok':
+            print('         {}'.format(r['error']))
+    num_ok = sum(1 for r in results if r['status'] == 'ok')
+    print('built {} of {} sets.'.format(num_ok, len(results)))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Create OCTGN packages for every set in a manifest.')
+    parser.add_argument('manifest',
+        help='file listing set spreadsheet URLs or set JSON files, one per line')
+    parser.add_argument('--workers', type=int, default=None,
+        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--report', default=default_report_path,
+        help='where to write the JSON report of results for each set')
+    parser.add_argument('--offline', action='store_true',
+        help='use saved snapshots of spreadsheets without going online')
+    parser.add_argument('--incremental', action='store_true',
+        help='only rebuild files and download card images that changed'
+             ' since the last build')
+    parser.add_argument('--separate-images', action='store_true',
+        help='put card images in a separate .o8c image pack for each set')
+    parser.add_argument('--image-quality', type=int, default=None,
+        help='shrink card images and re-encode them with this JPEG quality'
+             ' (needs Pillow)')
+    parser.add_argument('--fake-sheets', metavar='STATE',
+        help='read spreadsheets from fake spreadsheets saved by'
+             ' fake_services.py instead of Google Sheets')
+    parser.add_argument('--profile', action='store_true',
+        help='include the time spent in each phase of building each set, and'
+             ' counts of requests, images etc., in the report')
+    args = parser.parse_args()
+
+    sources = read_manifest(args.manifest)
+    results = build_catalog(
+        sources, args.workers, arkham_sheets.default_snapshot_dir,
+        args.offline, args.incremental, args.separate_images,
+        args.image_quality, args.profile, args.fake_sheets)
+
+    with open(args.report, 'w') as report_file:
+        json.dump(results, report_file, indent=2)
+    print_report(results)
+    print("Wrote report to {}".format(args.report))
+
+    if any(r['status'] != 'ok' for r in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,38 +2,163 @@
 
 # TODO: add module description
 
-import sys
-from arkham_sheets import read_set
-from octgn_package import create_octgn_data
-from octgn_image_pack import create_image_pack
-from zipfile import ZipFile
+import os
+import argparse
+import contextlib
+from arkham_sheets import read_set, default_snapshot_dir
+from octgn_build import default_state_dir
+from octgn_image_pack import create_image_pack, load_image_manifest
+import octgn_archive
+import octgn_build
+import profiling
+from octgn_package import create_set_data, create_scenario_files
 
-def create_octgn_package(url):
-    arkhamset = read_set(url)
 
-    set_path, scenario_file_path = create_octgn_data(arkhamset)
-    print("Created {} and {}".format(set_path, scenario_file_path))
+def get_archive_paths(arkhamset, separate_images):
+    data_path = "{}.zip".format(arkhamset['name'])
+    if separate_images:
+        return data_path, "{}.o8c".format(arkhamset['name'])
+    return data_path, None
 
-    imagedb_path = create_image_pack(arkhamset)
-    print("Created card image files at {}".format(imagedb_path))
 
-    set_zip_name = "{}.zip".format(arkhamset['name'])
-    with ZipFile(set_zip_name, "w") as package_zip:
-        package_zip.write(set_path)
-        package_zip.write(scenario_file_path)
-        package_zip.write(imagedb_path)
+# Write the scenario decks and card images of a set whose set XML file has
+# already been written, adding every file to the package archive as soon as
+# it's ready. The archive unzips into the OCTGN directory. With
+# separate_images=True the images go in their own .o8c image pack archive
+# instead. If image_quality is given, card images are normalized (see
+# octgn_image_pack.normalize_image). Returns the paths of the archives.
+#
+# With incremental=True, see update_package_archives.
+def create_package_archives(arkhamset, set_path, state_dir=None,
+                            incremental=False, separate_images=False,
+                            image_quality=None):
+    if incremental:
+        return update_package_archives(
+            arkhamset, set_path, state_dir, separate_images, image_quality)
 
-    print("Created package archive {}".format(set_zip_name))
-    return set_zip_name
+    data_path, images_path = get_archive_paths(arkhamset, separate_images)
+    archive_paths = [data_path]
+    # Both archives are closed however the build ends, even if closing the
+    # other one fails.
+    with contextlib.ExitStack() as archives:
+        data_archive = archives.enter_context(
+            octgn_archive.PackageArchive(data_path))
+        image_archive = data_archive
+        if separate_images:
+            image_archive = archives.enter_context(
+                octgn_archive.PackageArchive(images_path, "ImageDatabase"))
+            archive_paths.append(images_path)
+
+        data_archive.add_file(set_path)
+        scenario_paths = create_scenario_files(arkhamset, state_dir)
+        print("Created {} and {} scenario files".format(
+            set_path, len(scenario_paths)))
+        for scenario_path in scenario_paths:
+            data_archive.add_file(scenario_path)
+
+        imagedb_path = create_image_pack(
+            arkhamset, on_image=image_archive.add_file,
+            image_quality=image_quality)
+        print("Created card image files at {}".format(imagedb_path))
+
+        with profiling.timer('close_archives'):
+            archives.close()
+
+    for path in archive_paths:
+        print("Created package archive {}".format(path))
+    return archive_paths
+
+
+# Like create_package_archives, but only files whose inputs have changed are
+# rebuilt (see octgn_build), and the archives are written once all of their
+# files are ready, and only if any of those files have changed since the
+# archive was last written. A rebuild where nothing has changed doesn't
+# rewrite the archives at all.
+def update_package_archives(arkhamset, set_path, state_dir,
+                            separate_images=False, image_quality=None):
+    scenario_paths = create_scenario_files(arkhamset, state_dir)
+    imagedb_path = create_image_pack(
+        arkhamset, incremental=True, image_quality=image_quality)
+
+    # path -> hash of every file of each archive
+    data_files = {path: octgn_build.hash_file(path)
+                  for path in [set_path] + scenario_paths}
+    image_files = {}
+    for filename, entry in load_image_manifest(imagedb_path).items():
+        path = os.path.join(imagedb_path, filename)
+        if os.path.exists(path):    # not if its download failed
+            image_files[path] = entry['sha256']
+
+    data_path, images_path = get_archive_paths(arkhamset, separate_images)
+    if separate_images:
+        archives = [(data_path, os.curdir, data_files),
+                    (images_path, "ImageDatabase", image_files)]
+    else:
+        archives = [(data_path, os.curdir, dict(data_files, **image_files))]
+
+    for archive_path, root, files in archives:
+        if octgn_build.is_up_to_date(state_dir, archive_path, files):
+            print("Package archive {} is up to date".format(archive_path))
+            profiling.count('octgn.files_up_to_date')
+            continue
+        with profiling.timer('write_archives'):
+            with octgn_archive.PackageArchive(archive_path, root) as archive:
+                for path in files:
+                    archive.add_file(path)
+        octgn_build.record_build(state_dir, archive_path, files)
+        profiling.count('octgn.files_written')
+        print("Created package archive {}".format(archive_path))
+    return [archive_path for archive_path, _, _ in archives]
+
+
+# With incremental=True, OCTGN data files and card images that haven't changed
+# since the last build aren't generated or downloaded again. service and
+# drive_service are passed to read_set, e.g. to use a FakeSheetsService.
+def create_octgn_package(url, snapshot_dir=default_snapshot_dir,
+                         offline=False, incremental=False,
+                         separate_images=False, image_quality=None,
+                         service=None, drive_service=None):
+    arkhamset = read_set(url, service=service, drive_service=drive_service,
+                         snapshot_dir=snapshot_dir, offline=offline)
+
+    state_dir = default_state_dir if incremental else None
+    set_path = create_set_data(arkhamset, state_dir)
+    return create_package_archives(
+        arkhamset, set_path, state_dir, incremental, separate_images,
+        image_quality)
 
 
 def main():
-    if len(sys.argv) < 2:
-        print("args: url of sheet containing set data")
-        return
+    parser = argparse.ArgumentParser(
+        description='Create an OCTGN package from a set spreadsheet.')
+    parser.add_argument('url', help='url of sheet containing set data')
+    parser.add_argument('--offline', action='store_true',
+        help='use the saved snapshot of the sheet without going online')
+    parser.add_argument('--no-snapshot', action='store_true',
+        help='always read the sheet, and don\'t save a snapshot of it')
+    parser.add_argument('--incremental', action='store_true',
+        help='only rebuild files whose inputs changed since the last build')
+    parser.add_argument('--separate-images', action='store_true',
+        help='put card images in a separate .o8c image pack')
+    parser.add_argument('--image-quality', type=int, default=None,
+        help='shrink card images and re-encode them with this JPEG quality'
+             ' (needs Pillow)')
+    parser.add_argument('--fake-sheets', metavar='STATE',
+        help='read the sheet from fake spreadsheets saved by'
+             ' fake_services.py instead of Google Sheets')
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
 
-    url = sys.argv[1]
-    create_octgn_package(url)
+    snapshot_dir = None if args.no_snapshot else default_snapshot_dir
+    service = None
+    if args.fake_sheets:
+        # only imported when it's used, so real builds don't load it
+        from fake_services import FakeSheetsService
+        service = FakeSheetsService.load(args.fake_sheets)
+    with profiling.session(args.profile, args.cprofile_dir):
+        create_octgn_package(
+            args.url, snapshot_dir, args.offline, args.incremental,
+            args.separate_images, args.image_quality, service, service)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,614 @@
+#!/usr/bin/env python3
+
+# Local stand-ins for the web services the package talks to, so that the whole
+# pipeline can be run, timed and load tested on a machine with no network.
+#
+# FakeSheetsService is an in-memory version of the parts of the Google Sheets
+# API (v4) that arkham_sheets uses: spreadsheets().get/create and
+# spreadsheets().values().get/update/batchGet/batchUpdate. It also implements
+# the Drive API's files().get for the spreadsheet's modifiedTime, so the same
+# object can be passed to arkham_sheets.read_set as both service and
+# drive_service. Its spreadsheets can be saved to and loaded from a JSON file.
+#
+# RecordedPagesServer serves cardgamedb pages and card images recorded in an
+# http_cache directory (e.g. by running cardgamedb_scraper with its cache
+# enabled) from a local HTTP server, optionally adding latency to every
+# request. Links to the recorded sites in the pages it serves are rewritten to
+# point at the local server, so scraping a set from it also gets the card pages
+# and image URLs from it.
+#
+# From the command line:
+#   fake_services.py serve CACHE_DIR [--port PORT] [--latency SECONDS]
+#   fake_services.py record SET_FILE CACHE_DIR
+#   fake_services.py sheets STATE.json SET_FILE...
+# record makes synthetic cardgamedb pages for a set (see record_synthetic_set),
+# for when there's no real recording to serve. sheets puts each set in a new
+# fake spreadsheet saved in STATE.json and prints its URL, to use with
+# create_octgn_package.py --fake-sheets STATE.json.
+
+import re
+import copy
+import html
+import json
+import math
+import time
+import uuid
+import argparse
+import datetime
+import mimetypes
+import threading
+import urllib.parse
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import arkham_common
+import arkham_sheets
+import http_cache
+
+
+class FakeServiceError(Exception):
+    """Raised by fake services for requests a real service would refuse."""
+    pass
+
+
+#
+# Sheets
+#
+
+
+# 'Sheet!A2:D10', 'Sheet!A2:D' or 'A2:D10'
+a1_range_re = re.compile(
+    r"^(?:'?(?P<sheet>[^!']+)'?!)?"
+    r"(?P<col0>[A-Z]+)(?P<row0>\d*)(?::(?P<col1>[A-Z]+)(?P<row1>\d*))?$")
+
+
+def column_index(letters):
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index - 1
+
+
+# Returns (sheet title or None, first row, end row or None, first column, end
+# column or None), counting from 0 with exclusive ends.
+def parse_a1_range(a1):
+    m = a1_range_re.match(a1)
+    if not m:
+        raise FakeServiceError('Unable to parse range: {}'.format(a1))
+    row0 = int(m.group('row0')) - 1 if m.group('row0') else 0
+    col0 = column_index(m.group('col0'))
+    row1 = col1 = None
+    if m.group('col1'):
+        col1 = column_index(m.group('col1')) + 1
+        if m.group('row1'):
+            row1 = int(m.group('row1'))
+    else:
+        col1 = col0 + 1
+        row1 = row0 + 1
+    return m.group('sheet'), row0, row1, col0, col1
+
+
+def transpose(rows):
+    width = max((len(row) for row in rows), default=0)
+    return [[row[i] if i < len(row) else '' for row in rows]
+            for i in range(width)]
+
+
+# The API leaves out trailing empty cells and rows.
+def trim_values(rows):
+    rows = [list(row) for row in rows]
+    for row in rows:
+        while row and row[-1] == '':
+            row.pop()
+    while rows and not rows[-1]:
+        rows.pop()
+    return rows
+
+
+def get_cell_string(cell):
+    value = cell.get('userEnteredValue', {})
+    for kind in ('stringValue', 'numberValue', 'boolValue', 'formulaValue'):
+        if kind in value:
+            return str(value[kind])
+    return cell.get('formattedValue', '')
+
+
+# Cells are stored as the strings they were written as, which is also how they
+# are shown. With valueRenderOption UNFORMATTED_VALUE or FORMULA the real API
+# returns the value the string was parsed to with valueInputOption
+# USER_ENTERED, so numbers and booleans come back as JSON numbers and booleans.
+# Formulas aren't evaluated: they are returned as written either way.
+def get_unformatted_value(v):
+    if v in ('TRUE', 'FALSE'):
+        return v == 'TRUE'
+    try:
+        number = float(v)
+    except ValueError:
+        return v
+    if not math.isfinite(number) or v != v.strip():
+        return v
+    return int(number) if number.is_integer() else number
+
+
+# A request, run when execute() is called like a googleapiclient HttpRequest.
+class FakeRequest:
+    def __init__(self, service, method, *args):
+        self.service = service
+        self.method = method
+        self.args = args
+
+    def execute(self, num_retries=0):
+        if self.service.latency:
+            time.sleep(self.service.latency)
+        with self.service.lock:
+            self.service.num_requests += 1
+            return copy.deepcopy(self.method(*self.args))
+
+
+class FakeValuesResource:
+    def __init__(self, service):
+        self.service = service
+
+    def get(self, spreadsheetId, range, majorDimension='ROWS',
+            valueRenderOption='FORMATTED_VALUE', **kwargs):
+        return FakeRequest(self.service, self.service.read_values,
+                           spreadsheetId, range, majorDimension,
+                           valueRenderOption)
+
+    def batchGet(self, spreadsheetId, ranges, majorDimension='ROWS',
+                 valueRenderOption='FORMATTED_VALUE', **kwargs):
+        if isinstance(ranges, str):
+            ranges = [ranges]
+        def batch_get():
+            return {
+                'spreadsheetId': spreadsheetId,
+                'valueRanges': [self.service.read_values(
+                    spreadsheetId, r, majorDimension, valueRenderOption)
+                    for r in ranges],
+            }
+        return FakeRequest(self.service, batch_get)
+
+    def update(self, spreadsheetId, range, body, valueInputOption=None,
+               **kwargs):
+        return FakeRequest(self.service, self.service.write_values,
+                           spreadsheetId, range, body)
+
+    def batchUpdate(self, spreadsheetId, body, **kwargs):
+        def batch_update():
+            responses = [
+                self.service.write_values(spreadsheetId, vr['range'], vr)
+                for vr in body.get('data', [])]
+            return {
+                'spreadsheetId': spreadsheetId,
+                'totalUpdatedCells': sum(r['updatedCells'] for r in responses),
+                'responses': responses,
+            }
+        return FakeRequest(self.service, batch_update)
+
+
+class FakeSpreadsheetsResource:
+    def __init__(self, service):
+        self.service = service
+
+    def get(self, spreadsheetId, includeGridData=False, **kwargs):
+        return FakeRequest(self.service, self.service.get_spreadsheet,
+                           spreadsheetId, includeGridData)
+
+    def create(self, body, **kwargs):
+        return FakeRequest(self.service, self.service.create_spreadsheet, body)
+
+    def values(self):
+        return FakeValuesResource(self.service)
+
+
+class FakeFilesResource:
+    def __init__(self, service):
+        self.service = service
+
+    def get(self, fileId, fields=None, **kwargs):
+        def get_file():
+            spreadsheet = self.service.get_stored_spreadsheet(fileId)
+            metadata = {
+                'id': fileId,
+                'name': spreadsheet['title'],
+                'modifiedTime': spreadsheet['modified_time'],
+            }
+            if fields:
+                metadata = {k: v for k, v in metadata.items()
+                            if k in fields.split(',')}
+            return metadata
+        return FakeRequest(self.service, get_file)
+
+
+# Spreadsheets are stored as {'title', 'modified_time', 'sheets'}, where sheets
+# is a list of {'title', 'rows'} and rows is a list of lists of strings. Cell
+# values are always stored as strings, as the API returns them by default.
+class FakeSheetsService:
+    default_sheet_titles = ['Set', 'Cards', 'Scenarios']
+
+    # latency is the time in seconds each request takes
+    def __init__(self, latency=0):
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        self.store = {}
+        self.last_modified_time = None
+
+    def spreadsheets(self):
+        return FakeSpreadsheetsResource(self)
+
+    def files(self):
+        return FakeFilesResource(self)
+
+    def save(self, path):
+        with self.lock:
+            data = json.dumps(self.store)
+        with open(path, 'w') as f:
+            f.write(data)
+
+    @classmethod
+    def load(cls, path, latency=0):
+        service = cls(latency)
+        with open(path, 'r') as f:
+            service.store = json.load(f)
+        return service
+
+    # Put a set in a new spreadsheet, like create_spreadsheet_for_set in
+    # arkham_sheets, and return its URL.
+    def add_set(self, arkhamset):
+        spreadsheet = self.spreadsheets().create(body={
+            'properties': {
+                'title': 'Arkham Horror LCG: {}'.format(arkhamset['name'])},
+        }).execute()
+        arkham_sheets.fill_spreadsheet(
+            self, spreadsheet['spreadsheetId'], arkhamset)
+        return spreadsheet['spreadsheetUrl']
+
+    # The rest are called by FakeRequest.execute with self.lock held.
+
+    # Drive reports modification times to the millisecond. Make sure every
+    # modification gets a later time, so changes are never missed.
+    def touch(self, spreadsheet):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if self.last_modified_time and now <= self.last_modified_time:
+            now = self.last_modified_time + datetime.timedelta(milliseconds=1)
+        self.last_modified_time = now
+        spreadsheet['modified_time'] = (
+            now.isoformat(timespec='milliseconds').replace('+00:00', 'Z'))
+
+    def get_stored_spreadsheet(self, spreadsheet_id):
+        try:
+            return self.store[spreadsheet_id]
+        except KeyError:
+            raise FakeServiceError(
+                'Requested entity was not found: {}'.format(spreadsheet_id))
+
+    def get_sheet(self, spreadsheet_id, title):
+        sheets = self.get_stored_spreadsheet(spreadsheet_id)['sheets']
+        if title is None:
+            return sheets[0]
+        for sheet in sheets:
+            if sheet['title'] == title:
+                return sheet
+        raise FakeServiceError('Unable to parse range: {}'.format(title))
+
+    def create_spreadsheet(self, body):
+        spreadsheet_id = uuid.uuid4().hex
+        sheet_bodies = body.get('sheets') or [
+            {'properties': {'title': t}} for t in self.default_sheet_titles]
+        sheets = []
+        for sheet_body in sheet_bodies:
+            sheet = {'title': sheet_body['properties']['title'], 'rows': []}
+            for grid in sheet_body.get('data', []):
+                values = [[get_cell_string(c) for c in row.get('values', [])]
+                          for row in grid.get('rowData', [])]
+                write_grid(sheet['rows'], grid.get('startRow', 0),
+                           grid.get('startColumn', 0), values)
+            sheets.append(sheet)
+        spreadsheet = {
+            'title': body.get('properties', {}).get('title', 'Untitled'),
+            'sheets': sheets,
+        }
+        self.touch(spreadsheet)
+        self.store[spreadsheet_id] = spreadsheet
+        return self.get_spreadsheet(spreadsheet_id)
+
+    def get_spreadsheet(self, spreadsheet_id, include_grid_data=False):
+        spreadsheet = self.get_stored_spreadsheet(spreadsheet_id)
+        sheets = []
+        for i, sheet in enumerate(spreadsheet['sheets']):
+            sheet_body = {'properties': {'sheetId': i, 'title': sheet['title'],
+                                         'index': i}}
+            if include_grid_data:
+                sheet_body['data'] = [{'rowData': [
+                    {'values': [{'userEnteredValue': {'stringValue': v},
+                                 'formattedValue': v} for v in row]}
+                    for row in sheet['rows']]}]
+            sheets.append(sheet_body)
+        return {
+            'spreadsheetId': spreadsheet_id,
+            'properties': {'title': spreadsheet['title']},
+            'sheets': sheets,
+            'spreadsheetUrl':
+                'https://docs.google.com/spreadsheets/d/{}/edit'.format(
+                    spreadsheet_id),
+        }
+
+    def read_values(self, spreadsheet_id, a1, major_dimension='ROWS',
+                    value_render_option='FORMATTED_VALUE'):
+        title, row0, row1, col0, col1 = parse_a1_range(a1)
+        rows = self.get_sheet(spreadsheet_id, title)['rows'][row0:row1]
+        values = [row[col0:col1] for row in rows]
+        if value_render_option != 'FORMATTED_VALUE':
+            values = [[get_unformatted_value(v) for v in row]
+                      for row in values]
+        if major_dimension == 'COLUMNS':
+            values = transpose(values)
+        value_range = {'range': a1, 'majorDimension': major_dimension}
+        values = trim_values(values)
+        if values:
+            value_range['values'] = values
+        return value_range
+
+    def write_values(self, spreadsheet_id, a1, value_range):
+        title, row0, row1, col0, col1 = parse_a1_range(a1)
+        sheet = self.get_sheet(spreadsheet_id, title)
+        values = [['' if v is None else str(v) for v in row]
+                  for row in value_range.get('values', [])]
+        if value_range.get('majorDimension') == 'COLUMNS':
+            values = transpose(values)
+        write_grid(sheet['rows'], row0, col0, values)
+        self.touch(self.get_stored_spreadsheet(spreadsheet_id))
+        return {
+            'spreadsheetId': spreadsheet_id,
+            'updatedRange': a1,
+            'updatedCells': sum(len(row) for row in values),
+        }
+
+
+def write_grid(rows, row0, col0, values):
+    while len(rows) < row0 + len(values):
+        rows.append([])
+    for i, new_row in enumerate(values):
+        row = rows[row0 + i]
+        if len(row) < col0 + len(new_row):
+            row.extend([''] * (col0 + len(new_row) - len(row)))
+        row[col0:col0 + len(new_row)] = new_row
+
+
+#
+# Recorded web pages
+#
+
+
+class RecordedPagesServer:
+    def __init__(self, cache_dir=http_cache.default_cache_dir,
+                 host='127.0.0.1', port=0, latency=0):
+        self.cache = http_cache.HttpCache(cache_dir)
+        self.latency = latency
+        self.num_requests = 0
+        self.lock = threading.Lock()
+
+        # path and query -> recorded URL
+        self.urls = {}
+        hosts = set()
+        for url in self.cache.entries:
+            parts = urllib.parse.urlsplit(url)
+            hosts.add(parts.netloc)
+            self.urls[self.get_path(parts)] = url
+        self.recorded_hosts_re = re.compile('(?:https?:)?//(?:{})'.format(
+            '|'.join(re.escape(h) for h in sorted(hosts, key=len, reverse=True))
+        )) if hosts else None
+
+        self.server = ThreadingHTTPServer(
+            (host, port), self.make_handler_class())
+        self.server.daemon_threads = True
+        self.base_url = 'http://{}:{}'.format(*self.server.server_address[:2])
+        self.thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    @staticmethod
+    def get_path(parts):
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        return path
+
+    # the URL of the local copy of a recorded URL
+    def local_url(self, url):
+        return self.base_url + self.get_path(urllib.parse.urlsplit(url))
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    # returns (content type, body), or None if path wasn't recorded
+    def get_response(self, path):
+        url = self.urls.get(path)
+        if url is None:
+            return None
+        entry = self.cache.entries[url]
+        body = self.cache.read_blob(entry['hash'])
+        if body is None:
+            return None
+
+        content_type = mimetypes.guess_type(urllib.parse.urlsplit(url).path)[0]
+        if content_type is None or content_type.startswith('text/'):
+            encoding = entry.get('encoding') or 'utf-8'
+            text = body.decode(encoding, errors='replace')
+            if self.recorded_hosts_re:
+                text = self.recorded_hosts_re.sub(self.base_url, text)
+            body = text.encode(encoding, errors='replace')
+            content_type = '{}; charset={}'.format(
+                content_type or 'text/html', encoding)
+        return content_type, body
+
+    def make_handler_class(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with server.lock:
+                    server.num_requests += 1
+                if server.latency:
+                    time.sleep(server.latency)
+                response = server.get_response(self.path)
+                if response is None:
+                    self.send_error(404)
+                    return
+                content_type, body = response
+                self.send_response(200)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+# Synthetic recordings: pages in cardgamedb's layout made from a set, for load
+# testing when no real recording is available.
+
+cardgamedb_origin = 'http://www.cardgamedb.com'
+cardgamedb_set_path = '/index.php/arkhamhorror/arkham-horror-the-card-game/_/'
+
+
+def make_slug(name):
+    return re.sub('[^a-z0-9]+', '-', name.lower()).strip('-')
+
+
+def render_set_page(name, card_urls):
+    links = ''.join(
+        '<div class="cardText"><a href="{}">card</a></div>\n'.format(
+            html.escape(url)) for url in card_urls)
+    return '<html><body><h1>{}</h1>\n{}</body></html>'.format(
+        html.escape(name), links)
+
+
+# Fields whose values the scraper can't read back (it splits "Field: value" at
+# colons) are left out.
+def render_card_page(card, number, image_urls):
+    data = card['front']['data']
+    fields = [('Number', number), ('Quantity', card.get('quantity') or '1')]
+    if card.get('encounter_set'):
+        fields.append(('Encounter Set', card['encounter_set']))
+    fields.extend((k, v) for k, v in data.items()
+                  if k not in ('Text', 'Traits') and v)
+    divs = ['<div>{}: {}</div>'.format(html.escape(k), html.escape(v))
+            for k, v in fields if not re.search('[:<]', k + v)]
+    if data.get('Traits'):
+        divs.append('<div class="traits">{}</div>'.format(
+            html.escape(data['Traits'])))
+    divs.append('<div class="gameText">{}</div>'.format(
+        html.escape(data.get('Text', ''))))
+    if 'back' in card:
+        divs.append('<div class="gameText">{}</div>'.format(
+            html.escape(card['back']['data'].get('Text', ''))))
+    images = ''.join('<td><img src="{}"></td>'.format(html.escape(url))
+                     for url in image_urls)
+    return ('<html><body><h1>{}</h1>\n<div class="cardText">\n{}\n</div>\n'
+            '<table><tr>{}</tr></table></body></html>').format(
+                html.escape(card['front']['name']), '\n'.join(divs), images)
+
+
+# Record cardgamedb-style pages for arkhamset, and placeholder images of
+# image_size bytes, in an http_cache directory. The images aren't real JPEGs,
+# so don't normalize images downloaded from the recording. Returns the URL of
+# the recorded set page.
+def record_synthetic_set(arkhamset, cache_dir=http_cache.default_cache_dir,
+                         image_size=32 * 1024):
+    cache = http_cache.HttpCache(cache_dir)
+    set_slug = make_slug(arkhamset['name'])
+    set_url = cardgamedb_origin + cardgamedb_set_path + set_slug
+    card_urls = []
+    for i, card in enumerate(arkhamset['cards']):
+        number = card['number'] if card['number'].isdigit() else str(i + 1)
+        card_url = '{}/{}-r{}'.format(
+            set_url, make_slug(card['front']['name']) or 'card', i + 1)
+        image_urls = []
+        for side in ('front', 'back'):
+            if side in card:
+                image_url = '{}/forums/uploads/{}/{}-{}.jpg'.format(
+                    cardgamedb_origin, set_slug, i + 1, side)
+                placeholder = (b'\xff\xd8' + card_url.encode('utf-8')).ljust(
+                    image_size, b'\0')
+                cache.store(image_url, placeholder)
+                image_urls.append(image_url)
+        page = render_card_page(card, number, image_urls)
+        cache.store(card_url, page.encode('utf-8'), 'utf-8')
+        card_urls.append(card_url)
+
+    page = render_set_page(arkhamset['name'], card_urls)
+    cache.store(set_url + '?per_page=1000', page.encode('utf-8'), 'utf-8')
+    cache.save()
+    return set_url
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run local stand-ins for cardgamedb and Google Sheets.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = subparsers.add_parser('serve',
+        help='serve pages and images recorded in an HTTP cache directory')
+    serve_parser.add_argument('cache_dir', nargs='?',
+        default=http_cache.default_cache_dir,
+        help='cache directory written by cardgamedb_scraper')
+    serve_parser.add_argument('--port', type=int, default=8000)
+    serve_parser.add_argument('--latency', type=float, default=0,
+        help='seconds to wait before answering each request')
+
+    record_parser = subparsers.add_parser('record',
+        help='record synthetic cardgamedb pages for a set in a cache directory')
+    record_parser.add_argument('set_file', help='set to make pages for')
+    record_parser.add_argument('cache_dir', nargs='?',
+        default=http_cache.default_cache_dir)
+    record_parser.add_argument('--image-size', type=int, default=32 * 1024,
+        help='size in bytes of the placeholder card images')
+
+    sheets_parser = subparsers.add_parser('sheets',
+        help='put sets in fake spreadsheets saved to a state file')
+    sheets_parser.add_argument('state', help='JSON file of fake spreadsheets')
+    sheets_parser.add_argument('set_files', nargs='+', help='set files to add')
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        server = RecordedPagesServer(
+            args.cache_dir, port=args.port, latency=args.latency)
+        print("Serving {} recorded URLs at {}".format(
+            len(server.urls), server.base_url))
+        for url in sorted(server.cache.entries)[:5]:
+            print("  {} -> {}".format(url, server.local_url(url)))
+        try:
+            server.server.serve_forever()
+        except KeyboardInterrupt:
+            server.server.server_close()
+    elif args.command == 'record':
+        set_url = record_synthetic_set(arkham_common.load_set(args.set_file),
+                                       args.cache_dir, args.image_size)
+        print("Recorded set page {}".format(set_url))
+    else:
+        try:
+            service = FakeSheetsService.load(args.state)
+        except FileNotFoundError:
+            service = FakeSheetsService()
+        for path in args.set_files:
+            url = service.add_set(arkham_common.load_set(path))
+            print("{}: {}".format(path, url))
+        service.save(args.state)
+
+
+if __name__ == '__main__':
+    main()
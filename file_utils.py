@@ -0,0 +1,19 @@
+# helpers for writing files safely
+
+import os
+import tempfile
+
+
+# Write data to path atomically: it's written to a temporary file which is then
+# renamed over path, so a crash never leaves a partial file. The file is made
+# readable by everyone, like a file created with open().
+def write_file_atomic(path, data):
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or os.curdir)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
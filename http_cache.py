@@ -0,0 +1,152 @@
+# Persistent on-disk cache for HTTP GET requests, shared by cardgamedb_scraper
+# and octgn_image_pack so that repeated runs only transfer what has changed.
+#
+# Response bodies are stored once per distinct content under
+# <cache dir>/objects/<sha256 of body>. index.json maps each URL to the hash of
+# its last body plus the ETag/Last-Modified validators the server sent, which
+# are used to make conditional requests. When the stored bodies exceed the size
+# limit, the least recently used URLs are evicted.
+
+import os
+import json
+import time
+import hashlib
+import threading
+import collections
+import requests
+import profiling
+from file_utils import write_file_atomic
+
+
+default_cache_dir = '.http_cache'
+default_max_bytes = 1024**3      # 1 GB
+
+CachedResponse = collections.namedtuple(
+    'CachedResponse', ['status_code', 'content', 'encoding', 'from_cache'])
+
+
+class HttpCache:
+    def __init__(self, path=default_cache_dir, max_bytes=default_max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.objects_path = os.path.join(path, 'objects')
+        self.index_path = os.path.join(path, 'index.json')
+        self.lock = threading.Lock()
+        self.stats = {
+            'hits': 0,              # server said our copy is still current
+            'misses': 0,            # had to download the body
+            'bytes_downloaded': 0,
+            'bytes_saved': 0,       # size of bodies we didn't have to download
+        }
+
+        os.makedirs(self.objects_path, exist_ok=True)
+        self.entries = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as index_file:
+                self.entries = json.load(index_file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.save()
+
+    def blob_path(self, digest):
+        return os.path.join(self.objects_path, digest)
+
+    def read_blob(self, digest):
+        try:
+            with open(self.blob_path(digest), 'rb') as blob:
+                return blob.read()
+        except FileNotFoundError:
+            return None
+
+    # GET url, revalidating our stored copy with the server if we have one.
+    # Only 200 responses are cached; other statuses are passed through.
+    def fetch(self, url, session=None, headers=None, timeout=None):
+        with self.lock:
+            entry = self.entries.get(url)
+        content = self.read_blob(entry['hash']) if entry else None
+
+        request_headers = dict(headers or {})
+        if content is not None:
+            if entry.get('etag'):
+                request_headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                request_headers['If-Modified-Since'] = entry['last_modified']
+
+        r = (session or requests).get(
+            url, headers=request_headers, timeout=timeout)
+        profiling.count('http.requests')
+
+        if r.status_code == 304 and content is not None:
+            with self.lock:
+                entry['last_used'] = time.time()
+                self.stats['hits'] += 1
+                self.stats['bytes_saved'] += len(content)
+            profiling.count('http.cache_hits')
+            profiling.count('http.bytes_saved', len(content))
+            return CachedResponse(304, content, entry.get('encoding'), True)
+
+        if r.status_code != 200:
+            return CachedResponse(r.status_code, r.content, r.encoding, False)
+
+        content = r.content
+        self.store(url, content, r.encoding, r.headers.get('ETag', ''),
+                   r.headers.get('Last-Modified', ''))
+        with self.lock:
+            self.stats['misses'] += 1
+            self.stats['bytes_downloaded'] += len(content)
+        profiling.count('http.cache_misses')
+        profiling.count('http.bytes_downloaded', len(content))
+        return CachedResponse(200, content, r.encoding, False)
+
+    # Record content as the body of url, as if it had just been downloaded.
+    def store(self, url, content, encoding=None, etag='', last_modified=''):
+        digest = hashlib.sha256(content).hexdigest()
+        if not os.path.exists(self.blob_path(digest)):
+            write_file_atomic(self.blob_path(digest), content)
+
+        with self.lock:
+            self.entries[url] = {
+                'hash': digest,
+                'size': len(content),
+                'etag': etag,
+                'last_modified': last_modified,
+                'encoding': encoding,
+                'last_used': time.time(),
+            }
+            self.evict()
+
+    # Drop least recently used URLs until the stored bodies fit in max_bytes.
+    # Several URLs may share one body, which is deleted once none refer to it.
+    # Must be called with self.lock held.
+    def evict(self):
+        blob_sizes = {e['hash']: e['size'] for e in self.entries.values()}
+        total = sum(blob_sizes.values())
+        if total <= self.max_bytes:
+            return
+
+        refcounts = collections.Counter(e['hash'] for e in self.entries.values())
+        by_age = sorted(self.entries, key=lambda u: self.entries[u]['last_used'])
+        for url in by_age:
+            if total <= self.max_bytes:
+                break
+            digest = self.entries.pop(url)['hash']
+            refcounts[digest] -= 1
+            if not refcounts[digest]:
+                total -= blob_sizes[digest]
+                try:
+                    os.remove(self.blob_path(digest))
+                except FileNotFoundError:
+                    pass
+
+    def save(self):
+        with self.lock:
+            data = json.dumps(self.entries).encode('utf-8')
+        write_file_atomic(self.index_path, data)
+
+    def format_stats(self):
+        return (
+            'http cache: {hits} hits, {misses} misses, {bytes_downloaded} bytes'
+            ' downloaded, {bytes_saved} bytes saved'.format(**self.stats))
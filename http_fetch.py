@@ -0,0 +1,71 @@
+# Helpers shared by the modules that fetch pages and images from the web
+# (cardgamedb_scraper, octgn_image_pack).
+
+import threading
+import time
+import urllib.parse
+import requests
+import profiling
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+user_agent = 'Mozilla/5.0'
+
+# Seconds to wait for a server to respond before giving up on a request.
+default_timeout = 30
+
+# Responses with these statuses are retried, as are connection errors.
+retry_statuses = [429, 500, 502, 503, 504]
+
+
+# Throttle requests so that no single host sees more than `rate` requests per
+# second, no matter how many worker threads are fetching at once. A rate of
+# None or 0 disables throttling.
+class RateLimiter:
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = {}     # host -> earliest time the next request may start
+
+    def wait(self, url):
+        if not self.interval:
+            return
+        host = urllib.parse.urlsplit(url).netloc
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot.get(host, now))
+            self.next_slot[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+# Create a session whose connections are kept alive and shared between up to
+# `pool_size` threads. Failed requests are retried `retries` times, sleeping
+# backoff * 2**n seconds between attempts.
+def create_session(pool_size=10, retries=3, backoff=0.5):
+    retry = Retry(
+        total=retries, backoff_factor=backoff,
+        status_forcelist=retry_statuses, allowed_methods=['GET', 'HEAD'],
+        raise_on_status=False)
+    adapter = HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['User-agent'] = user_agent
+    return session
+
+
+# Fetch the text of a web page. If an http_cache.HttpCache is given, the page
+# is only downloaded if it has changed since it was cached.
+def get_page(url, rate_limiter=None, session=None, cache=None):
+    if rate_limiter is not None:
+        rate_limiter.wait(url)
+    if cache is None:
+        r = (session or requests).get(url, timeout=default_timeout)
+        profiling.count('http.requests')
+        profiling.count('http.bytes_downloaded', len(r.content))
+        return r.text
+    r = cache.fetch(url, session, timeout=default_timeout)
+    return r.content.decode(r.encoding or 'utf-8', errors='replace')
@@ -0,0 +1,58 @@
+# Zip archives for distributing OCTGN packages and image packs (.o8c).
+#
+# Files are added to an archive as soon as they're generated, while the rest of
+# the package is still being built: each archive has its own writer thread
+# which compresses and writes files in the order they were added. Images are
+# stored as-is since JPEG and PNG data is already compressed, and everything
+# else is deflated. zlib releases the GIL, so separate archives are compressed
+# in parallel.
+
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+
+precompressed_extensions = {'.jpg', '.jpeg', '.png'}
+
+
+def get_compress_type(path):
+    if os.path.splitext(path)[1].lower() in precompressed_extensions:
+        return zipfile.ZIP_STORED
+    return zipfile.ZIP_DEFLATED
+
+
+class PackageArchive:
+    # Files are stored under their path relative to root. For an OCTGN package
+    # that's the OCTGN directory (the current directory); for an image pack
+    # it's the ImageDatabase directory.
+    def __init__(self, path, root=os.curdir):
+        self.path = path
+        self.root = root
+        self.zip = zipfile.ZipFile(path, 'w')
+        self.writer = ThreadPoolExecutor(max_workers=1)
+        self.pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Queue a file to be written to the archive. Safe to call from any thread.
+    def add_file(self, path):
+        arcname = os.path.relpath(path, self.root)
+        self.pending.append(self.writer.submit(
+            self.zip.write, path, arcname, get_compress_type(path)))
+
+    # Wait for all queued files to be written and finish the archive. Raises
+    # the first error from writing any of the files.
+    def close(self):
+        if self.writer is None:
+            return
+        self.writer.shutdown(wait=True)
+        self.writer = None
+        try:
+            for future in self.pending:
+                future.result()
+        finally:
+            self.zip.close()
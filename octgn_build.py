@@ -0,0 +1,94 @@
+# Records of what each generated OCTGN file was built from, so that a rebuild
+# can skip files whose inputs haven't changed.
+#
+# For every output file (a set.xml or a scenario .o8d) we store a dict of
+# hashes of its inputs: the set or scenario data it was made from, the code
+# that made it and, for decks, the set.xml of every set it takes cards from.
+# The hash of the output itself is stored too, so edited files get rebuilt,
+# along with its mtime and size so that unchanged outputs needn't be reread.
+# Since decks depend on set.xml files by content, regenerating a set.xml with
+# different content causes every deck that uses it to be rebuilt too.
+#
+# Each record is a small JSON file under the state directory, named after the
+# output path, so builds of different sets in parallel never write to the same
+# record.
+
+import os
+import json
+import hashlib
+import arkham_common
+from file_utils import write_file_atomic
+
+
+default_state_dir = '.octgn_build'
+
+# path -> (mtime, size, hash), to avoid rereading unchanged files
+file_hashes = {}
+
+
+def hash_bytes(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+# obj may contain the typed objects from arkham_common
+def hash_json(obj):
+    data = json.dumps(arkham_common.to_plain_data(obj), sort_keys=True,
+                      separators=(',', ':'))
+    return hash_bytes(data.encode('utf-8'))
+
+
+def hash_file(path):
+    stat = os.stat(path)
+    cached = file_hashes.get(path)
+    if cached and cached[:2] == (stat.st_mtime_ns, stat.st_size):
+        return cached[2]
+    with open(path, 'rb') as f:
+        digest = hash_bytes(f.read())
+    file_hashes[path] = (stat.st_mtime_ns, stat.st_size, digest)
+    return digest
+
+
+# The mtime and size of a file. A file whose mtime and size are the same as
+# when it was hashed is taken to be unchanged without reading it again.
+def get_file_stat(path):
+    stat = os.stat(path)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def file_matches(path, digest, file_stat=None):
+    if file_stat is not None and get_file_stat(path) == file_stat:
+        return True
+    return hash_file(path) == digest
+
+
+def get_record_path(state_dir, output_path):
+    name = hash_bytes(os.path.normpath(output_path).encode('utf-8'))
+    return os.path.join(state_dir, name + '.json')
+
+
+def is_up_to_date(state_dir, output_path, inputs):
+    if not os.path.exists(output_path):
+        return False
+    try:
+        with open(get_record_path(state_dir, output_path), 'r') as f:
+            record = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return False
+    return (
+        record['output'] == output_path
+        and record['inputs'] == inputs
+        and file_matches(output_path, record['output_hash'],
+                         record.get('output_stat')))
+
+
+def record_build(state_dir, output_path, inputs):
+    record = {
+        'output': output_path,
+        'output_hash': hash_file(output_path),
+        'output_stat': get_file_stat(output_path),
+        'inputs': inputs,
+    }
+    os.makedirs(state_dir, exist_ok=True)
+    # written atomically, so an interrupted build never leaves a partial record
+    write_file_atomic(get_record_path(state_dir, output_path),
+                      json.dumps(record, indent=2).encode('utf-8'))
@@ -1,10 +1,48 @@
 #!/usr/bin/env python3
 
+import io
 import os
 import re
+import json
+import argparse
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import requests
-import shutil
 import arkham_common
+import http_fetch
+import http_cache
+import octgn_archive
+import octgn_build
+import octgn_package
+import profiling
+
+try:
+  from PIL import Image
+except ImportError:     # Pillow is only needed to normalize images
+  Image = None
+
+
+# number of images to download at once
+default_download_workers = 8
+
+# JPEG quality for normalized images (see normalize_image)
+default_image_quality = 85
+
+# (long edge, short edge) in pixels that normalized images are shrunk to fit,
+# for each card size from octgn_package.get_card_size
+card_image_dimensions = {
+  'InvestigatorCard': (1050, 750),
+  'HorizCard': (1050, 750),
+  'EncounterCard': (700, 500),
+  'MiniCard': (350, 250),
+  None: (700, 500),
+}
+
+manifest_filename = 'manifest.json'
+
+
+class ImageDownloadError(Exception):
+  """Raised when a card image can't be downloaded."""
+  pass
 
 
 def get_extension_from_url(url):
@@ -14,39 +52,264 @@ def get_extension_from_url(url):
   return ext
 
 
-def download_img(url, dest):
-  r = requests.get(url, stream=True, headers={'User-agent': 'Mozilla/5.0'})
-  if r.status_code == 200:
+def download_img(url, dest, session=None, cache=None):
+  if cache is not None:
+    try:
+      r = cache.fetch(
+          url, session, headers={'User-agent': http_fetch.user_agent},
+          timeout=http_fetch.default_timeout)
+    except requests.RequestException as e:
+      raise ImageDownloadError(str(e))
+    if r.status_code not in (200, 304):
+      raise ImageDownloadError('HTTP status {}'.format(r.status_code))
     with open(dest, 'wb') as f:
-      r.raw.decode_content = True
-      shutil.copyfileobj(r.raw, f)
-    return True
-  else:
-    print("WARNING: couldn't download image URL: {}, destination: {}".format(url, dest))
-    return False
+      f.write(r.content)
+    return
+
+  try:
+    r = (session or requests).get(
+        url, stream=True, timeout=http_fetch.default_timeout,
+        headers={'User-agent': http_fetch.user_agent})
+  except requests.RequestException as e:
+    raise ImageDownloadError(str(e))
+  profiling.count('http.requests')
+  with r:
+    if r.status_code != 200:
+      raise ImageDownloadError('HTTP status {}'.format(r.status_code))
+    # iter_content turns errors reading the body (timeouts, dropped
+    # connections) into RequestExceptions; the partial file is removed
+    try:
+      with open(dest, 'wb') as f:
+        for chunk in r.iter_content(chunk_size=1 << 16):
+          f.write(chunk)
+        profiling.count('http.bytes_downloaded', f.tell())
+    except (requests.RequestException, OSError) as e:
+      try:
+        os.remove(dest)
+      except FileNotFoundError:
+        pass
+      raise ImageDownloadError(str(e))
+
+
+def get_card_size(card):
+  if 'Type' not in card['front']['data']:
+    return None
+  return octgn_package.get_card_size(card)
 
 
-# download all card images, set filename = GUID, put in correct directory
-def create_card_image_files(arkhamset, path):
-  num = 0
+# list of (card id, side, url, destination path without extension, card size)
+# for each image of each card in the set
+def get_card_image_jobs(arkhamset, path):
+  jobs = []
   for card in arkhamset['cards']:
+    size = get_card_size(card)
     url_front = card['front'].get('image_url', '')
-    dest_front = os.path.join(
-        path, card['id'] + get_extension_from_url(url_front))
-    if download_img(url_front, dest_front):
-      num += 1
+    jobs.append(
+        (card['id'], 'front', url_front, os.path.join(path, card['id']), size))
 
     if arkham_common.is_double_sided(card):
-      url_back = card['back']['image_url']
-      dest_back = os.path.join(
-        path, card['id'] + '.b' + get_extension_from_url(url_back))
-      if download_img(url_back, dest_back):
-        num += 1
+      url_back = card['back'].get('image_url', '')
+      jobs.append((card['id'], 'back', url_back,
+                   os.path.join(path, card['id'] + '.b'), size))
+
+  return jobs
+
+
+# Shrink an image file to fit the dimensions for its card size (in whichever
+# orientation the image has) and re-encode it with the given JPEG quality,
+# dropping any metadata. PNGs stay PNGs. The file is left alone if it's already
+# small enough and re-encoding wouldn't make it smaller. This is run in a
+# worker process. Returns the size of the file before and after.
+def normalize_image(path, card_size, quality):
+  old_size = os.path.getsize(path)
+  long_edge, short_edge = card_image_dimensions.get(
+      card_size, card_image_dimensions[None])
+
+  with Image.open(path) as img:
+    img.load()
+    image_format = img.format
+  if img.width >= img.height:
+    box = (long_edge, short_edge)
+  else:
+    box = (short_edge, long_edge)
+  resized = img.width > box[0] or img.height > box[1]
+  if resized:
+    img.thumbnail(box, Image.LANCZOS)
+  img.info = {}
+
+  data = io.BytesIO()
+  if image_format == 'PNG':
+    img.save(data, 'PNG', optimize=True)
+  else:
+    if img.mode not in ('RGB', 'L'):
+      img = img.convert('RGB')
+    img.save(data, 'JPEG', quality=quality, optimize=True, progressive=True)
+  data = data.getvalue()
+
+  if not resized and len(data) >= old_size:
+    return old_size, old_size
+  with open(path, 'wb') as f:
+    f.write(data)
+  return old_size, len(data)
+
+
+# The manifest lives beside the Cards directory and records, for each image
+# file in it, the card and side it belongs to, the URL it came from and the
+# hash, size and mtime of its contents. Incremental builds use it to skip
+# images whose URL hasn't changed and whose file is still intact; files whose
+# mtime and size are unchanged aren't rehashed.
+def get_manifest_path(path):
+  return os.path.join(os.path.dirname(os.path.normpath(path)), manifest_filename)
+
+
+def load_image_manifest(path):
+  try:
+    with open(get_manifest_path(path), 'r') as manifest_file:
+      return json.load(manifest_file)
+  except FileNotFoundError:
+    return {}
+
+
+def save_image_manifest(path, manifest):
+  with open(get_manifest_path(path), 'w') as manifest_file:
+    json.dump(manifest, manifest_file, indent=2, sort_keys=True)
+
+
+def image_is_up_to_date(entry, url, dest, quality):
+  return (
+    entry is not None
+    and entry['url'] == url
+    and entry.get('quality') == quality
+    and os.path.exists(dest)
+    and os.path.getsize(dest) == entry['size']
+    and octgn_build.file_matches(dest, entry['sha256'], entry.get('stat')))
+
+
+# download all card images, set filename = GUID, put in correct directory.
+# Pass an http_cache.HttpCache to avoid downloading unchanged images again.
+#
+# In incremental mode, images that the manifest says were already downloaded
+# from the same URL are skipped, and image files for cards no longer in the set
+# are deleted.
+#
+# on_image, if given, is called with the path of each image file as soon as it
+# has been downloaded (or found to be up to date), from a download thread.
+#
+# If image_quality is given, each downloaded image is normalized with
+# normalize_image in a pool of worker processes. This needs Pillow.
+#
+# session is the requests.Session to download with; by default a new one is
+# made with a connection pool for the download threads.
+#
+# Returns a summary dict with the number of images downloaded and skipped, the
+# files removed, (url, destination, reason) for each failed download and the
+# number of bytes saved by normalizing images.
+def create_card_image_files(arkhamset, path, workers=default_download_workers,
+                            cache=None, incremental=False, on_image=None,
+                            image_quality=None, session=None):
+  if image_quality is not None and Image is None:
+    raise ImportError("Pillow is needed to normalize card images")
+  if session is None:
+    session = http_fetch.create_session(pool_size=max(1, workers))
+  old_manifest = load_image_manifest(path) if incremental else {}
+  normalizer = ProcessPoolExecutor() if image_quality is not None else None
+
+  # returns (manifest filename, manifest entry, skipped, failure, bytes saved)
+  def download(job):
+    card_id, side, url, dest_base, card_size = job
+    try:
+      dest = dest_base + get_extension_from_url(url)
+    except ValueError:
+      return None, None, False, (url, dest_base, 'bad image URL'), 0
+    filename = os.path.basename(dest)
+    old_entry = old_manifest.get(filename)
+    if image_is_up_to_date(old_entry, url, dest, image_quality):
+      if on_image:
+        on_image(dest)
+      return filename, old_entry, True, None, 0
+    try:
+      download_img(url, dest, session, cache)
+    except ImageDownloadError as e:
+      return filename, old_entry, False, (url, dest, str(e)), 0
+
+    bytes_saved = 0
+    if normalizer is not None:
+      try:
+        old_size, new_size = normalizer.submit(
+            normalize_image, dest, card_size, image_quality).result()
+      # any error, not just OSError: Pillow's DecompressionBombError and a
+      # broken worker pool fail just this image too
+      except Exception as e:
+        reason = "couldn't normalize image: {}".format(e)
+        return filename, None, False, (url, dest, reason), 0
+      bytes_saved = old_size - new_size
+
+    if on_image:
+      on_image(dest)
+    entry = {
+      'card_id': card_id,
+      'side': side,
+      'url': url,
+      'sha256': octgn_build.hash_file(dest),
+      'size': os.path.getsize(dest),
+      'stat': octgn_build.get_file_stat(dest),
+      'quality': image_quality,
+    }
+    return filename, entry, False, None, bytes_saved
+
+  try:
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+      results = list(
+          executor.map(download, get_card_image_jobs(arkhamset, path)))
+  finally:
+    if normalizer is not None:
+      normalizer.shutdown()
+
+  summary = {'downloaded': 0, 'skipped': 0, 'removed': [], 'failures': [],
+             'bytes_saved': 0}
+  manifest = {}
+  for filename, entry, skipped, failure, bytes_saved in results:
+    if entry is not None:
+      manifest[filename] = entry
+    summary['bytes_saved'] += bytes_saved
+    if failure:
+      summary['failures'].append(failure)
+    elif skipped:
+      summary['skipped'] += 1
+    else:
+      summary['downloaded'] += 1
+
+  if incremental:
+    for filename in os.listdir(path):
+      if filename not in manifest:
+        os.remove(os.path.join(path, filename))
+        summary['removed'].append(filename)
+  save_image_manifest(path, manifest)
+
+  profiling.count('images.downloaded', summary['downloaded'])
+  profiling.count('images.skipped', summary['skipped'])
+  profiling.count('images.failed', len(summary['failures']))
+  profiling.count('images.bytes_saved', summary['bytes_saved'])
+
+  return summary
+
 
-  return num
+def print_download_summary(summary):
+  num = summary['downloaded'] + summary['skipped']
+  print("{} of {} card images are up to date ({} downloaded, {} unchanged).".format(
+      num, num + len(summary['failures']), summary['downloaded'],
+      summary['skipped']))
+  if summary['bytes_saved']:
+    print("normalizing images saved {} bytes.".format(summary['bytes_saved']))
+  for filename in summary['removed']:
+    print("  removed {}".format(filename))
+  for url, dest, reason in summary['failures']:
+    print("  FAILED: {} -> {} ({})".format(url, dest, reason))
 
 
-def create_image_pack(arkhamset):
+def create_image_pack(arkhamset, workers=default_download_workers,
+                      cache=None, incremental=False, on_image=None,
+                      image_quality=None):
     # create image files for cards
     imagedb_path = os.path.join(
         "ImageDatabase", arkham_common.octgn_game_id, "Sets",
@@ -55,24 +318,56 @@ def create_image_pack(arkhamset):
       os.makedirs(imagedb_path)
     except FileExistsError:
       pass
-    num = create_card_image_files(arkhamset, imagedb_path)
-    print("created {} card image files in {}.".format(num, imagedb_path))
-    # TODO: zip images into o8c file
+    with profiling.timer('images'):
+      summary = create_card_image_files(
+          arkhamset, imagedb_path, workers, cache, incremental, on_image,
+          image_quality)
+    print_download_summary(summary)
+    print("created {} card image files in {}.".format(
+        summary['downloaded'], imagedb_path))
     return imagedb_path
 
 
-def create_image_pack_for_set_from_json_file(json_file_path):
-    arkhamset = arkham_common.load_set(json_file_path)
-    return create_image_pack(arkhamset)
+# Download the card images and put them in an .o8c image pack archive, adding
+# each image as soon as it has been downloaded. Returns the path of the archive.
+def create_image_pack_for_set_from_json_file(json_file_path, cache=None,
+                                             incremental=False,
+                                             image_quality=None):
+    arkhamset = arkham_common.load_set(json_file_path, typed=True)
+    o8c_path = "{}.o8c".format(arkhamset['name'])
+    with octgn_archive.PackageArchive(o8c_path, "ImageDatabase") as archive:
+      create_image_pack(arkhamset, cache=cache, incremental=incremental,
+                        on_image=archive.add_file, image_quality=image_quality)
+    return o8c_path
 
 
 def main():
-    if len(sys.argv) < 2:
-        print("args: path to json file containing set data")
-        return
+    parser = argparse.ArgumentParser(
+        description='Download card images for an OCTGN image pack.')
+    parser.add_argument('path', help='path to json file containing set data')
+    parser.add_argument('--incremental', action='store_true',
+        help='only download images that changed since the last build')
+    parser.add_argument('--normalize', action='store_true',
+        help='shrink and re-encode downloaded images (needs Pillow)')
+    parser.add_argument('--quality', type=int, default=default_image_quality,
+        help='JPEG quality for normalized images')
+    parser.add_argument('--cache-dir', default=http_cache.default_cache_dir,
+        help='directory for cached card images')
+    parser.add_argument('--no-cache', action='store_true',
+        help="don't use or update the card image cache")
+    profiling.add_arguments(parser)
+    args = parser.parse_args()
 
-    path = sys.argv[1]
-    o8c_path = create_image_pack_for_set_from_json_file(path)
+    image_quality = args.quality if args.normalize else None
+    with profiling.session(args.profile, args.cprofile_dir):
+      if args.no_cache:
+        o8c_path = create_image_pack_for_set_from_json_file(
+            args.path, None, args.incremental, image_quality)
+      else:
+        with http_cache.HttpCache(args.cache_dir) as cache:
+          o8c_path = create_image_pack_for_set_from_json_file(
+              args.path, cache, args.incremental, image_quality)
+        print(cache.format_stats())
     print("created image pack {}".format(o8c_path))
 
 
@@ -4,8 +4,11 @@
 import uuid
 import os
 import re
+import threading
 import xml.etree.ElementTree as ET
 import arkham_common
+import octgn_build
+import profiling
 
 
 # directories to search to find existing sets.
@@ -59,6 +62,9 @@ octgn_symbol_map = {
 
 octgn_symbol_map.update(skill_icon_symbols)
 
+translate_symbols_for_octgn = arkham_common.make_symbol_translator(
+    octgn_symbol_map)
+
 octgn_scenario_sections = [
     'Act',
     'Agenda',
@@ -73,6 +79,24 @@ octgn_forbidden_side_fields = [
     'Wild',
 ]
 
+# characters escaped in XML attribute values, in the order ElementTree does it
+xml_attrib_entities = [
+    ('&', '&amp;'),
+    ('<', '&lt;'),
+    ('>', '&gt;'),
+    ('"', '&quot;'),
+    ('\r', '&#13;'),
+    ('\n', '&#10;'),
+    ('\t', '&#09;'),
+]
+
+# set.xml card properties that are copied into scenario cards
+scenario_card_properties = {
+    'Card Number': 'number',
+    'Quantity': 'quantity',
+    'Encounter Set': 'encounter_set',
+}
+
 
 # things people might enter in the source field that we want to interpret
 source_alias = {
@@ -90,22 +114,44 @@ class SetDataError(Exception):
     pass
 
 
-# in-place prettyprint formatter
-# from http://effbot.org/zone/element-lib.htm#prettyprint
+# Parsed source sets, shared by every scenario built in this process.
+# uuid -> ((path, mtime, size), SetIndex). See load_source_set.
+source_set_cache = {}
+source_set_cache_lock = threading.Lock()
+
+
+# in-place prettyprint formatter, producing the same output as the recursive
+# version from http://effbot.org/zone/element-lib.htm#prettyprint
+# Uses an explicit stack rather than recursion so that deep trees can't hit the
+# recursion limit.
 def indent(elem, level=0):
-    i = "\n" + level*"  "
-    if len(elem):
-        if not elem.text or not elem.text.strip():
-            elem.text = i + "  "
-        if not elem.tail or not elem.tail.strip():
-            elem.tail = i
-        for elem in elem:
-            indent(elem, level+1)
+    indentations = {}
+
+    def indentation(level):
+        if level not in indentations:
+            indentations[level] = "\n" + level*"  "
+        return indentations[level]
+
+    i = indentation(level)
+    if len(elem) or level:
         if not elem.tail or not elem.tail.strip():
             elem.tail = i
-    else:
-        if level and (not elem.tail or not elem.tail.strip()):
-            elem.tail = i
+
+    stack = [(elem, level)]
+    while stack:
+        elem, level = stack.pop()
+        if not len(elem):
+            continue
+        child_i = indentation(level + 1)
+        if not elem.text or not elem.text.strip():
+            elem.text = child_i
+        for child in elem:
+            if not child.tail or not child.tail.strip():
+                child.tail = child_i
+            if len(child):
+                stack.append((child, level + 1))
+        if not child.tail.strip():
+            child.tail = indentation(level)
 
 
 def get_card_size(card):
@@ -125,9 +171,7 @@ def get_card_size(card):
 # convert arkhamset card text into OCTGN xml card text
 def format_text_for_octgn(text):
     # TODO: handle any weird XML stuff?
-    for k, v in octgn_symbol_map.items():
-        text = text.replace(k, v)
-    return text
+    return translate_symbols_for_octgn(text)
 
 
 def format_side_data_fields_for_octgn(side):
@@ -166,7 +210,7 @@ def format_side_for_octgn(side):
 
 def format_card_for_octgn(card):
     if 'id' not in card:
-        card['id'] = uuid.uuid4()
+        card['id'] = str(uuid.uuid4())
 
     format_side_for_octgn(card['front'])
     if arkham_common.is_double_sided(card):
@@ -177,38 +221,57 @@ def format_card_for_octgn(card):
         card['size'] = size
 
 
-def card_to_xml_element(card):
+# Get the XML attributes and properties of a card (after formatting it for
+# OCTGN), as (front_attrib, front_properties, back_attrib, back_properties).
+# Properties are lists of (name, value). The back values are None for single
+# sided cards.
+def get_card_xml_fields(card):
     format_card_for_octgn(card)
 
     front_attrib = {'id': card['id'], 'name': card['front']['name']}
     if card.get('size', ''):
         front_attrib['size'] = card['size']
-    front_root = ET.Element('card', front_attrib)
 
-    ET.SubElement(front_root, 'property', {'name': 'Card Number', 'value': card['number']})
-    ET.SubElement(front_root, 'property', {'name': 'Quantity', 'value': card['quantity']})
+    front_properties = [
+        ('Card Number', card['number']),
+        ('Quantity', card['quantity']),
+    ]
+    if 'encounter_set' in card:
+        front_properties.append(('Encounter Set', card['encounter_set']))
+    front_properties.extend(card['front']['data'].items())
+
+    if not arkham_common.is_double_sided(card):
+        return front_attrib, front_properties, None, None
+
+    back_attrib = {'name': card['back']['name'], 'type': 'B'}
+    if card.get('size', ''):
+        back_attrib['size'] = card['size']
+    back_properties = []
     if 'encounter_set' in card:
-        ET.SubElement(front_root, 'property', {'name': 'Encounter Set', 'value': card['encounter_set']})
-    for k, v in card['front']['data'].items():
+        back_properties.append(('Encounter Set', card['encounter_set']))
+    back_properties.extend(card['back']['data'].items())
+
+    return front_attrib, front_properties, back_attrib, back_properties
+
+
+def card_to_xml_element(card):
+    front_attrib, front_properties, back_attrib, back_properties = (
+        get_card_xml_fields(card))
+
+    front_root = ET.Element('card', front_attrib)
+    for k, v in front_properties:
         ET.SubElement(front_root, 'property', {'name': k, 'value': v})
 
-    if arkham_common.is_double_sided(card):
-        back_attrib = {'name': card['back']['name'], 'type': 'B'}
-        if card.get('size', ''):
-            back_attrib['size'] = card['size']
+    if back_attrib is not None:
         back_root = ET.SubElement(front_root, 'alternate', back_attrib)
-        if 'encounter_set' in card:
-            ET.SubElement(back_root, 'property', {'name': 'Encounter Set', 'value': card['encounter_set']})
-        for k, v in card['back']['data'].items():
+        for k, v in back_properties:
             ET.SubElement(back_root, 'property', {'name': k, 'value': v})
 
     return front_root
 
 
-# create XML tree containing metadata on all cards in this set
-def create_set_xml(arkhamset):
-    # TODO: figure out XML header? Or generate it with args to ET.write()?
-    set_attrib = {
+def get_set_xml_attrib(arkhamset):
+    return {
         'xmlns:noNamespaceSchemaLocation': 'CardSet.xsd',   # is this right?
         'name': arkhamset['name'],
         'id': arkhamset['id'],
@@ -216,7 +279,12 @@ def create_set_xml(arkhamset):
         'gameVersion': '1.0.0.0',
         'version': '1.0.0',
     }
-    set_root = ET.Element('set', set_attrib)
+
+
+# create XML tree containing metadata on all cards in this set
+def create_set_xml(arkhamset):
+    # TODO: figure out XML header? Or generate it with args to ET.write()?
+    set_root = ET.Element('set', get_set_xml_attrib(arkhamset))
     cards_root = ET.SubElement(set_root, 'cards')
     for card in arkhamset['cards']:
         cards_root.append(card_to_xml_element(card))
@@ -224,50 +292,134 @@ def create_set_xml(arkhamset):
     indent(set_root)
     return set_root
 
-# Read data from an XML element describing a card and use it to fill in missing
-# fields for a scenario card.
-def update_scenario_card_from_xml_element(scenario_card, tag):
+
+# escape an attribute value the same way ElementTree does
+def escape_xml_attrib(value):
+    value = str(value)
+    for char, entity in xml_attrib_entities:
+        if char in value:
+            value = value.replace(char, entity)
+    return value
+
+
+def xml_tag(tag, attrib, empty=False):
+    attrs = ''.join(
+        ' {}="{}"'.format(k, escape_xml_attrib(v)) for k, v in attrib.items())
+    return '<{}{}{}>'.format(tag, attrs, ' /' if empty else '')
+
+
+def write_xml_properties(f, properties, level):
+    for k, v in properties:
+        f.write('  '*level + xml_tag('property', {'name': k, 'value': v}, True)
+                + '\n')
+
+
+# Write the set XML file one card at a time instead of building the whole
+# element tree first. The output is byte-for-byte what writing the tree from
+# create_set_xml with ElementTree.write would produce.
+def write_set_xml(arkhamset, path):
+    with open(path, 'w', encoding='utf-8', errors='xmlcharrefreplace',
+              newline='\n') as f:
+        f.write("<?xml version='1.0' encoding='UTF-8'?>\n")
+        f.write(xml_tag('set', get_set_xml_attrib(arkhamset)) + '\n')
+        if not arkhamset['cards']:
+            f.write('  <cards />\n</set>\n')
+            profiling.count('xml.elements', 2)
+            return
+
+        f.write('  <cards>\n')
+        num_elements = 2
+        for card in arkhamset['cards']:
+            front_attrib, front_properties, back_attrib, back_properties = (
+                get_card_xml_fields(card))
+            num_elements += 1 + len(front_properties)
+            if back_attrib is not None:
+                num_elements += 1 + len(back_properties)
+            f.write('    ' + xml_tag('card', front_attrib) + '\n')
+            write_xml_properties(f, front_properties, 3)
+            if back_attrib is not None:
+                if back_properties:
+                    f.write('      ' + xml_tag('alternate', back_attrib) + '\n')
+                    write_xml_properties(f, back_properties, 4)
+                    f.write('      </alternate>\n')
+                else:
+                    f.write('      ' + xml_tag('alternate', back_attrib, True)
+                            + '\n')
+            f.write('    </card>\n')
+        f.write('  </cards>\n</set>\n')
+    profiling.count('xml.elements', num_elements)
+
+
+# Read the fields of a scenario card from an XML element describing a card.
+def read_scenario_card_fields(tag):
     card_from_tag = {
         'id': tag.attrib['id'],
         'name': tag.attrib['name'],
     }
-    find_number = tag.find("./property[@name='Card Number']")
-    if find_number is not None:
-        card_from_tag['number'] = find_number.attrib['value']
-
-    find_quantity = tag.find("./property[@name='Quantity']")
-    if find_quantity is not None:
-        card_from_tag['quantity'] = find_quantity.attrib['value']
+    for prop in tag.iterfind('./property'):
+        field = scenario_card_properties.get(prop.attrib.get('name'))
+        if field and field not in card_from_tag:
+            card_from_tag[field] = prop.attrib['value']
+    return card_from_tag
 
-    find_encounter_set = tag.find("./property[@name='Encounter Set']")
-    if find_encounter_set is not None:
-        card_from_tag['encounter_set'] = find_encounter_set.attrib['value']
 
+# Fill in missing fields for a scenario card from fields read from the set XML.
+def update_scenario_card_from_fields(scenario_card, card_from_tag):
     scenario_card.update(card_from_tag)
 
     # We should now have values for all of these fields.
     needed_fields = {'id', 'name', 'number', 'quantity', 'encounter_set'}
     missing_fields = needed_fields.difference(set(scenario_card))
     if missing_fields:
-        error_msg = (
-            "Missing fields after loading card data XML: {}\n".format(missing_fields)
-            + scenario_card)
+        error_msg = "Missing fields after loading card data XML: {}\n{}".format(
+            missing_fields, scenario_card)
         raise SetDataError(error_msg)
 
     return scenario_card
 
 
+# Read data from an XML element describing a card and use it to fill in missing
+# fields for a scenario card.
+def update_scenario_card_from_xml_element(scenario_card, tag):
+    return update_scenario_card_from_fields(
+        scenario_card, read_scenario_card_fields(tag))
+
+
+# Lookup tables over the cards in a parsed set.xml, built in one pass so that
+# resolving a scenario card doesn't need an XPath scan over the whole set.
+class SetIndex:
+    def __init__(self, root):
+        self.root = root
+        self.elements_by_id = {}
+        self.elements_by_name_and_number = {}
+        self.elements_by_name = {}
+        self.fields_by_id = {}          # id -> fields from read_scenario_card_fields
+        self.encounter_sets = {}        # encounter set name -> [fields]
+
+        for tag in root.iterfind('./cards/card'):
+            fields = read_scenario_card_fields(tag)
+            self.elements_by_id.setdefault(fields['id'], tag)
+            self.fields_by_id.setdefault(fields['id'], fields)
+            self.elements_by_name.setdefault(fields['name'], tag)
+            if 'number' in fields:
+                self.elements_by_name_and_number.setdefault(
+                    (fields['name'], fields['number']), tag)
+            if 'encounter_set' in fields:
+                self.encounter_sets.setdefault(
+                    fields['encounter_set'], []).append(fields)
+
+    def get_fields(self, element):
+        return self.fields_by_id[element.attrib['id']]
+
+
 # Get a list of scenario_card objects corresponding to a given encounter set
 # We don't care about recording the source of these cards because presumably
 # the caller must already know it.
 #       name: name of encounter set
-#       root: root of xml tree of the set which contains given encounter set
-def get_encounter_set(name, root):
-    XPath_query_string = (
-        "./cards/card/property[@name='Encounter Set'][@value='{}']/.."
-        .format(name))
-    cards = [update_scenario_card_from_xml_tag({}, tag)
-                for tag in root.findall(XPath_query_string)]
+#       index: SetIndex of the set which contains given encounter set
+def get_encounter_set(name, index):
+    cards = [update_scenario_card_from_fields({}, fields)
+                for fields in index.encounter_sets.get(name, [])]
     return cards
 
 
@@ -283,15 +435,14 @@ def create_xml_element_for_scenario_card(card):
 
 
 # Given a card with possibly incomplete information, find the corresponding
-# XML element in that card's set's XML tree. Card must either have an ID or both
+# XML element in that card's set's index. Card must either have an ID or both
 # name and number.
-def find_xml_element_for_scenario_card(card, xml_root):
+def find_xml_element_for_scenario_card(card, index):
     if card.get('id', ''): # find card based on id
-        return xml_root.find("./cards/card[@id='{}']".format(card['id']))
-    elif card['name'] and card['number']: # find card based on name and number
-        return xml_root.find(
-            "./cards/card/property[@name='{}' and @number='{}']/.."
-            .format(card['name'], card['number']))
+        return index.elements_by_id.get(card['id'])
+    elif card['name'] and card.get('number', ''): # find card based on name and number
+        return index.elements_by_name_and_number.get(
+            (card['name'], card['number']))
     else:
         error_msg = "Not enough fields to identify card: {}".format(card)
         raise SetDataError(error_msg)
@@ -322,6 +473,37 @@ def get_existing_set_xml_path(source):
     raise SetDataError(error_msg)
 
 
+# Get the SetIndex for the existing set with the given uuid, parsing its
+# set.xml only if we haven't already parsed the same version of the file.
+def load_source_set(source):
+    path = get_existing_set_xml_path(source)
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    with source_set_cache_lock:
+        cached = source_set_cache.get(source)
+    if cached is not None and cached[0] == key:
+        return cached[1]
+
+    try:
+        index = SetIndex(ET.parse(path).getroot())
+    except ET.ParseError:
+        print("Couldn't parse XML for source {}".format(source))
+        raise
+    with source_set_cache_lock:
+        source_set_cache[source] = (key, index)
+    return index
+
+
+# Forget parsed source sets, e.g. after rewriting a set.xml. With no argument
+# the whole cache is cleared.
+def invalidate_source_set(source=None):
+    with source_set_cache_lock:
+        if source is None:
+            source_set_cache.clear()
+        else:
+            source_set_cache.pop(source, None)
+
+
 def scenario_card_entry_is_encounter_set(card):
     return (
         card.get('encounter_set', '')
@@ -336,13 +518,12 @@ def scenario_card_entry_is_token(card):
         'markers and tokens', campaign_ids['markers and tokens']))
 
 
-def get_token(card, xml_root):
-    element = xml_root.find(
-        "./cards/card/property[@name='{}']/..".format(card['name']))
-    if not element:
+def get_token(card, index):
+    element = index.elements_by_name.get(card['name'])
+    if element is None:
         error_msg = "Couldn't find this in the tokens list: {}".format(card)
         raise SetDataError(error_msg)
-    elif element.attrib['size'] != 'ChaosToken':
+    elif element.attrib.get('size', '') != 'ChaosToken':
         error_msg = "It looks like this is not a token: {}".format(card)
         raise SetDataError(error_msg)
 
@@ -380,19 +561,14 @@ def create_scenario_xml(scenario, set_id):
     # Now we can do one lookup pass per source.
     for source in cards_by_source:
 
-        try:
-            path = get_existing_set_xml_path(source)
-            source_root = ET.parse(path).getroot()
-        except ET.ParseError:
-            print("Couldn't parse XML for source {}".format(source))
-            raise
+        source_index = load_source_set(source)
 
         for section, cards in cards_by_source[source].items():
             while cards:
                 card = cards.pop()
                 if scenario_card_entry_is_encounter_set(card):
                     encounter_set = get_encounter_set(
-                        card['encounter_set'], source_root)
+                        card['encounter_set'], source_index)
                     if not encounter_set:
                         error_msg = (
                             "Couldn't find any cards for encounter set {}"
@@ -412,8 +588,13 @@ def create_scenario_xml(scenario, set_id):
                         for k in ['id', 'name', 'number', 'quantity']]
                     ):
                         element = find_xml_element_for_scenario_card(card,
-                            source_root)
-                        update_scenario_card_from_xml_element(card, element)
+                            source_index)
+                        if element is None:
+                            error_msg = "Couldn't find card {} in source {}".format(
+                                card, source)
+                            raise SetDataError(error_msg)
+                        update_scenario_card_from_fields(
+                            card, source_index.get_fields(element))
 
                     section_roots[section].append(
                         create_xml_element_for_scenario_card(card))
@@ -426,43 +607,149 @@ def create_scenario_xml(scenario, set_id):
     return deck_root
 
 
-def create_octgn_data(arkhamset):
+def get_set_xml_dir(arkhamset):
+    return os.path.join(
+        "GameDatabase", arkham_common.octgn_game_id, "Sets", arkhamset['id'])
+
+
+# create xml file containing all cards in set.
+# If state_dir is given, the file is only written if the set has changed since
+# it was last written (see octgn_build).
+@profiling.timer('set_xml')
+def create_set_data(arkhamset, state_dir=None):
     if 'id' not in arkhamset or not arkhamset['id']:
-        arkhamset['id'] = uuid.uuid4()
+        arkhamset['id'] = str(uuid.uuid4())
 
-    # create xml file containing all cards in set
-    set_dir = os.path.join(
-        "GameDatabase", arkham_common.octgn_game_id, "Sets", arkhamset['id'])
+    set_dir = get_set_xml_dir(arkhamset)
     try:
         os.makedirs(set_dir)
     except FileExistsError:
         pass
     set_filename = 'set.xml'
     set_path = os.path.join(set_dir, set_filename)
-    set_root = create_set_xml(arkhamset)
-    xml_tree = ET.ElementTree(set_root)
-    xml_tree.write(set_path, encoding='UTF-8', xml_declaration=True)
+
+    if state_dir:
+        inputs = get_set_xml_inputs(arkhamset)
+        if octgn_build.is_up_to_date(state_dir, set_path, inputs):
+            print("set XML file {} is up to date.".format(set_path))
+            profiling.count('octgn.files_up_to_date')
+            assign_card_ids_from_set_xml(arkhamset, set_path)
+            return set_path
+
+    write_set_xml(arkhamset, set_path)
+    invalidate_source_set(arkhamset['id'])
+    if state_dir:
+        octgn_build.record_build(state_dir, set_path, inputs)
+    profiling.count('octgn.files_written')
     print("created set XML file {}.".format(set_path))
+    return set_path
 
-    # create xml file for each scenario with cards needed for play
+
+# Cards without an id are given a new one when the set XML file is written. If
+# the file is up to date and isn't rewritten, they get the ids they were given
+# then instead, so that images and decks made from the set match it. The cards
+# are in the file in the same order as in the set.
+def assign_card_ids_from_set_xml(arkhamset, set_path):
+    if all(card.get('id') for card in arkhamset['cards']):
+        return
+    ids = [tag.attrib['id'] for _, tag in ET.iterparse(set_path)
+           if tag.tag == 'card']
+    if len(ids) != len(arkhamset['cards']):
+        raise SetDataError("{} has {} cards, but the set has {}".format(
+            set_path, len(ids), len(arkhamset['cards'])))
+    for card, card_id in zip(arkhamset['cards'], ids):
+        if not card.get('id'):
+            card['id'] = card_id
+
+
+# Generated files depend on this module and on arkham_common (symbol
+# translation, the OCTGN game id etc.), so changing either rebuilds them.
+generator_files = [__file__, arkham_common.__file__]
+
+
+def get_generator_hashes():
+    return [octgn_build.hash_file(path) for path in generator_files]
+
+
+def get_set_xml_inputs(arkhamset):
+    return {
+        'generator': get_generator_hashes(),
+        'set': octgn_build.hash_json({
+            k: arkhamset.get(k) for k in ('id', 'name', 'cards')}),
+    }
+
+
+# uuids of the sets a scenario takes cards from
+def get_scenario_sources(scenario, set_id):
+    sources = set()
+    for section in octgn_scenario_sections:
+        for card in scenario.get(section, []):
+            card = dict(card)
+            validate_source_field(card, set_id)
+            sources.add(card['source'])
+    return sorted(sources)
+
+
+def get_scenario_inputs(scenario, set_id):
+    return {
+        'generator': get_generator_hashes(),
+        'scenario': octgn_build.hash_json([set_id, scenario]),
+        'sources': {
+            source: octgn_build.hash_file(get_existing_set_xml_path(source))
+            for source in get_scenario_sources(scenario, set_id)
+        },
+    }
+
+
+def get_scenario_path(scenario):
+    campaign_dir = "{} - {}".format(
+            scenario['campaign_code'], scenario['campaign'])
+    scenario_filename = "{} - {}.o8d".format(
+        scenario['number'], scenario['name'])
+    return os.path.join(
+        "Decks", "Arkham Horror - The Card Game", campaign_dir,
+        scenario_filename)
+
+
+# create xml file for each scenario with cards needed for play. The set's XML
+# file must already exist, as must those of any other sets the scenarios use.
+# If state_dir is given, only scenarios whose data or source sets have changed
+# since they were last written are written again (see octgn_build).
+@profiling.timer('scenarios')
+def create_scenario_files(arkhamset, state_dir=None):
     #gamedb_decks_path = "GameDatabase/{}/Decks/".format(game_id)
-    game_path = os.path.join("Decks", "Arkham Horror - The Card Game")
+    scenario_paths = []
     for scenario in arkhamset.get('scenarios', []):
-        campaign_dir = "{} - {}".format(
-                scenario['campaign_code'], scenario['campaign'])
-        campaign_path = os.path.join(game_path, campaign_dir)
+        scenario_path = get_scenario_path(scenario)
+        scenario_paths.append(scenario_path)
         try:
-            os.makedirs(campaign_path)
+            os.makedirs(os.path.dirname(scenario_path))
         except FileExistsError:
             pass
-        scenario_filename = "{} - {}.o8d".format(
-            scenario['number'], scenario['name'])
-        scenario_path = os.path.join(campaign_path, scenario_filename)
+
+        if state_dir:
+            inputs = get_scenario_inputs(scenario, arkhamset['id'])
+            if octgn_build.is_up_to_date(state_dir, scenario_path, inputs):
+                print("scenario file {} is up to date.".format(scenario_path))
+                profiling.count('octgn.files_up_to_date')
+                continue
 
         scenario_root = create_scenario_xml(scenario, arkhamset['id'])
         scenario_xml_tree = ET.ElementTree(scenario_root)
         scenario_xml_tree.write(
             scenario_path, encoding='UTF-8', xml_declaration=True)
+        if state_dir:
+            octgn_build.record_build(state_dir, scenario_path, inputs)
+        profiling.count('octgn.files_written')
+        profiling.count('xml.elements', sum(1 for _ in scenario_root.iter()))
         print("created scenario file {}.".format(scenario_path))
 
-    return (set_path, scenario_path)
+    return scenario_paths
+
+
+# returns path of the set XML file and list of paths of scenario deck files.
+# If state_dir is given, files whose inputs haven't changed are not rewritten.
+def create_octgn_data(arkhamset, state_dir=None):
+    set_path = create_set_data(arkhamset, state_dir)
+    scenario_paths = create_scenario_files(arkhamset, state_dir)
+    return (set_path, scenario_paths)
@@ -0,0 +1,118 @@
+# Timers and counters for seeing where the time goes in a build.
+#
+# Phases of the build are timed with `with profiling.timer('name'):` and
+# things like HTTP requests or XML elements written are counted with
+# profiling.count('name', n). Both are cheap enough to leave in all the time;
+# the totals build up in this module until get_report() or reset() is called.
+#
+# Timers can be nested, and a nested timer is reported as 'outer/inner'. Timers
+# started in worker threads aren't nested under the phase that started the
+# thread. When cProfile output is enabled, each outermost phase in the main
+# thread is also run under cProfile and its stats are written to
+# <cprofile_dir>/<phase>.prof, which can be read with pstats or snakeviz.
+#
+# Entry points call add_arguments on their argument parser and wrap their work
+# in `with profiling.session(args.profile, args.cprofile_dir):` to support
+# --profile and --cprofile-dir.
+
+import os
+import sys
+import json
+import time
+import cProfile
+import threading
+import contextlib
+import collections
+
+
+# name -> [seconds, calls]
+timings = collections.defaultdict(lambda: [0.0, 0])
+counters = collections.Counter()
+lock = threading.Lock()
+
+# names of the timers running in each thread
+local = threading.local()
+
+# where to write cProfile stats for each phase, or None
+cprofile_dir = None
+
+
+def reset():
+    with lock:
+        timings.clear()
+        counters.clear()
+
+
+def count(name, n=1):
+    with lock:
+        counters[name] += n
+
+
+@contextlib.contextmanager
+def timer(name):
+    stack = getattr(local, 'stack', None)
+    if stack is None:
+        stack = local.stack = []
+    stack.append(name)
+    full_name = '/'.join(stack)
+
+    profiler = None
+    if (cprofile_dir and len(stack) == 1
+            and threading.current_thread() is threading.main_thread()):
+        profiler = cProfile.Profile()
+        profiler.enable()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        if profiler:
+            profiler.disable()
+            os.makedirs(cprofile_dir, exist_ok=True)
+            profiler.dump_stats(
+                os.path.join(cprofile_dir, name.replace('/', '_') + '.prof'))
+        stack.pop()
+        with lock:
+            timing = timings[full_name]
+            timing[0] += elapsed
+            timing[1] += 1
+
+
+def get_report():
+    with lock:
+        return {
+            'timings': {name: {'seconds': round(seconds, 6), 'calls': calls}
+                        for name, (seconds, calls) in sorted(timings.items())},
+            'counters': dict(sorted(counters.items())),
+        }
+
+
+def add_arguments(parser):
+    parser.add_argument('--profile', metavar='PATH', default=None,
+        help='write a JSON report of the time spent in each phase and of'
+             ' counts of requests, bytes, etc. to PATH')
+    parser.add_argument('--cprofile-dir', metavar='DIR', default=None,
+        help='also run each phase under cProfile and write its stats to DIR')
+
+
+# Collect timings and counts for a whole run of a program, with cProfile output
+# for each phase if profile_dir is given. If report_path is given, the report is
+# written there at the end, along with the total time of the run, even if the
+# run fails.
+@contextlib.contextmanager
+def session(report_path=None, profile_dir=None):
+    global cprofile_dir
+    cprofile_dir = profile_dir
+    reset()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        cprofile_dir = None
+        if report_path:
+            report = get_report()
+            report['argv'] = sys.argv
+            report['total_seconds'] = round(time.perf_counter() - start, 6)
+            with open(report_path, 'w') as report_file:
+                json.dump(report, report_file, indent=2)
+            print("Wrote profile report to {}".format(report_path))
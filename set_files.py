@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+
+# Reading and writing set data files.
+#
+# A set can be saved as plain JSON (.json), gzip-compressed JSON (.json.gz) or
+# a binary format (.arkhamset). The binary format lets tools that only need a
+# set's id, name and type read them without loading all of its cards, and is
+# the fastest to read and write when the msgpack package is installed. The
+# format of a file is chosen by its extension. Run this module with set files
+# as arguments to list the sets in them.
+#
+# The binary format is:
+#   the magic bytes b'ARKHAMSET' and a one byte format version
+#   a 4-byte big-endian length, followed by a MessagePack map of every field of
+#     the set except its cards, plus 'num_cards'
+#   a MessagePack array of the cards
+# MessagePack is encoded with the msgpack package if it's installed, or else
+# with the pure-Python encoder below, which writes the same encoding (but is
+# slower than the json module).
+#
+# JSON files record format_version in the set. Files without one were written
+# before it was added, and are version 1.
+#
+# Files are written to a temporary file which is then renamed over the
+# destination, so an interrupted write never leaves a truncated set file.
+
+import sys
+import gzip
+import json
+import struct
+from file_utils import write_file_atomic
+
+try:
+    import msgpack
+except ImportError:     # the pure-Python encoder is used instead
+    msgpack = None
+
+
+format_version = 1
+
+binary_magic = b'ARKHAMSET'
+
+# extension -> format name
+file_extensions = {
+    '.json': 'json',
+    '.json.gz': 'json.gz',
+    '.arkhamset': 'binary',
+}
+
+
+class SetFileError(Exception):
+    """Raised when a set file can't be read."""
+    pass
+
+
+def get_file_format(path):
+    for ext, file_format in file_extensions.items():
+        if path.endswith(ext):
+            return file_format
+    return 'json'
+
+
+def get_extension(file_format):
+    for ext, f in file_extensions.items():
+        if f == file_format:
+            return ext
+    raise ValueError('unknown set file format {}'.format(file_format))
+
+
+def check_format_version(version, path):
+    if version > format_version:
+        raise SetFileError(
+            '{} is format version {}, but only versions up to {} can be read'
+            .format(path, version, format_version))
+
+
+#
+# pure-Python MessagePack
+#
+
+
+def pack_length(out, n, fix_type, fix_max, types):
+    if n <= fix_max:
+        out.append(fix_type | n)
+        return
+    for type_byte, fmt in types:
+        if n < 1 << (8 * struct.calcsize(fmt)):
+            out.append(type_byte)
+            out += struct.pack(fmt, n)
+            return
+    raise ValueError('object too large to pack')
+
+
+def pack_object(obj, out):
+    if obj is None:
+        out.append(0xc0)
+    elif obj is False:
+        out.append(0xc2)
+    elif obj is True:
+        out.append(0xc3)
+    elif isinstance(obj, int):
+        if 0 <= obj < 0x80 or -32 <= obj < 0:
+            out += struct.pack('>b' if obj < 0 else '>B', obj)
+        elif obj >= 0:
+            for type_byte, fmt in [(0xcc, '>B'), (0xcd, '>H'), (0xce, '>I'),
+                                   (0xcf, '>Q')]:
+                if obj < 1 << (8 * struct.calcsize(fmt)):
+                    out.append(type_byte)
+                    out += struct.pack(fmt, obj)
+                    break
+            else:
+                raise ValueError('integer too large to pack')
+        else:
+            for type_byte, fmt in [(0xd0, '>b'), (0xd1, '>h'), (0xd2, '>i'),
+                                   (0xd3, '>q')]:
+                if obj >= -(1 << (8 * struct.calcsize(fmt) - 1)):
+                    out.append(type_byte)
+                    out += struct.pack(fmt, obj)
+                    break
+            else:
+                raise ValueError('integer too large to pack')
+    elif isinstance(obj, float):
+        out.append(0xcb)
+        out += struct.pack('>d', obj)
+    elif isinstance(obj, str):
+        data = obj.encode('utf-8')
+        pack_length(out, len(data), 0xa0, 31,
+                    [(0xd9, '>B'), (0xda, '>H'), (0xdb, '>I')])
+        out += data
+    elif isinstance(obj, (bytes, bytearray)):
+        pack_length(out, len(obj), 0xc4, -1,
+                    [(0xc4, '>B'), (0xc5, '>H'), (0xc6, '>I')])
+        out += obj
+    elif isinstance(obj, (list, tuple)):
+        pack_length(out, len(obj), 0x90, 15, [(0xdc, '>H'), (0xdd, '>I')])
+        for item in obj:
+            pack_object(item, out)
+    elif isinstance(obj, dict):
+        pack_length(out, len(obj), 0x80, 15, [(0xde, '>H'), (0xdf, '>I')])
+        for k, v in obj.items():
+            pack_object(k, out)
+            pack_object(v, out)
+    else:
+        raise TypeError("can't pack {}".format(type(obj).__name__))
+
+
+# format of the fixed size value following each type byte
+unpack_formats = {
+    0xca: '>f', 0xcb: '>d',
+    0xcc: '>B', 0xcd: '>H', 0xce: '>I', 0xcf: '>Q',
+    0xd0: '>b', 0xd1: '>h', 0xd2: '>i', 0xd3: '>q',
+}
+
+# (kind, format of the length) following each type byte of a variable size value
+unpack_lengths = {
+    0xc4: ('bin', '>B'), 0xc5: ('bin', '>H'), 0xc6: ('bin', '>I'),
+    0xd9: ('str', '>B'), 0xda: ('str', '>H'), 0xdb: ('str', '>I'),
+    0xdc: ('array', '>H'), 0xdd: ('array', '>I'),
+    0xde: ('map', '>H'), 0xdf: ('map', '>I'),
+}
+
+
+# returns (object, position after it)
+def unpack_object(data, pos):
+    b = data[pos]
+    pos += 1
+    if b < 0x80:
+        return b, pos
+    elif b >= 0xe0:
+        return b - 0x100, pos
+    elif 0xa0 <= b <= 0xbf:
+        kind, n = 'str', b & 0x1f
+    elif 0x90 <= b <= 0x9f:
+        kind, n = 'array', b & 0x0f
+    elif 0x80 <= b <= 0x8f:
+        kind, n = 'map', b & 0x0f
+    elif b == 0xc0:
+        return None, pos
+    elif b == 0xc2:
+        return False, pos
+    elif b == 0xc3:
+        return True, pos
+    elif b in unpack_formats:
+        fmt = unpack_formats[b]
+        return struct.unpack_from(fmt, data, pos)[0], pos + struct.calcsize(fmt)
+    elif b in unpack_lengths:
+        kind, fmt = unpack_lengths[b]
+        n = struct.unpack_from(fmt, data, pos)[0]
+        pos += struct.calcsize(fmt)
+    else:
+        raise ValueError('unsupported MessagePack type 0x{:02x}'.format(b))
+
+    if kind == 'str':
+        return str(data[pos:pos + n], 'utf-8'), pos + n
+    elif kind == 'bin':
+        return bytes(data[pos:pos + n]), pos + n
+    elif kind == 'array':
+        items = []
+        for _ in range(n):
+            item, pos = unpack_object(data, pos)
+            items.append(item)
+        return items, pos
+    else:
+        d = {}
+        for _ in range(n):
+            k, pos = unpack_object(data, pos)
+            d[k], pos = unpack_object(data, pos)
+        return d, pos
+
+
+def packb(obj):
+    if msgpack is not None:
+        return msgpack.packb(obj, use_bin_type=True)
+    out = bytearray()
+    pack_object(obj, out)
+    return bytes(out)
+
+
+def unpackb(data):
+    if msgpack is not None:
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+    obj, pos = unpack_object(memoryview(data), 0)
+    if pos != len(data):
+        raise ValueError('extra data after MessagePack object')
+    return obj
+
+
+#
+# reading and writing
+#
+
+
+def encode_binary(arkhamset):
+    header = {k: v for k, v in arkhamset.items() if k != 'cards'}
+    header['num_cards'] = len(arkhamset.get('cards', []))
+    header = packb(header)
+    return b''.join([binary_magic, bytes([format_version]),
+                     struct.pack('>I', len(header)), header,
+                     packb(arkhamset.get('cards', []))])
+
+
+# Returns the set data without its cards, and the file positioned at the start
+# of the cards.
+def read_binary_header(f, path):
+    magic = f.read(len(binary_magic) + 1)
+    if magic[:-1] != binary_magic:
+        raise SetFileError('{} is not a binary set file'.format(path))
+    check_format_version(magic[-1], path)
+    length, = struct.unpack('>I', f.read(4))
+    return unpackb(f.read(length))
+
+
+# arkhamset must be a dict of plain data (see arkham_common.to_plain_data)
+def write_set_data(arkhamset, path):
+    file_format = get_file_format(path)
+    if file_format == 'binary':
+        write_file_atomic(path, encode_binary(arkhamset))
+        return
+
+    # json.dumps is much faster than json.dump, which encodes in pure Python
+    data = json.dumps(dict(arkhamset, format_version=format_version))
+    data = data.encode('utf-8')
+    if file_format == 'json.gz':
+        data = gzip.compress(data, compresslevel=6, mtime=0)
+    write_file_atomic(path, data)
+
+
+def read_set_data(path):
+    file_format = get_file_format(path)
+    try:
+        if file_format == 'binary':
+            with open(path, 'rb') as f:
+                arkhamset = read_binary_header(f, path)
+                del arkhamset['num_cards']
+                arkhamset['cards'] = unpackb(f.read())
+            return arkhamset
+
+        opener = gzip.open if file_format == 'json.gz' else open
+        with opener(path, 'rt', encoding='utf-8') as f:
+            arkhamset = json.load(f)
+    except (ValueError, OSError, struct.error) as e:
+        if isinstance(e, FileNotFoundError):
+            raise
+        raise SetFileError("couldn't read {}: {}".format(path, e))
+    check_format_version(arkhamset.pop('format_version', 1), path)
+    return arkhamset
+
+
+# Read everything about a set except its cards, plus 'num_cards'. For binary
+# files only the header is read; JSON files have to be read in full.
+def read_set_info(path):
+    if get_file_format(path) == 'binary':
+        try:
+            with open(path, 'rb') as f:
+                return read_binary_header(f, path)
+        except (ValueError, struct.error) as e:
+            raise SetFileError("couldn't read {}: {}".format(path, e))
+    arkhamset = read_set_data(path)
+    arkhamset['num_cards'] = len(arkhamset.pop('cards', []))
+    return arkhamset
+
+
+# List the name, id, type and number of cards of each set file given. Only the
+# header of binary files is read, so this is quick even for large catalogs.
+def main():
+    if len(sys.argv) < 2:
+        print("args: paths of set files")
+        return
+    for path in sys.argv[1:]:
+        try:
+            info = read_set_info(path)
+        except (SetFileError, OSError) as e:
+            print("{}: {}".format(path, e))
+            continue
+        print("{}: {} ({}, {}), {} cards".format(
+            path, info.get('name'), info.get('id'), info.get('type'),
+            info['num_cards']))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,175 @@
+# Tests for http_cache against a local HTTP server standing in for cardgamedb.
+# Run with `python -m pytest`.
+
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import pytest
+import http_cache
+
+
+# Serves the bodies in `pages` (path -> bytes). With validator 'etag' or
+# 'last_modified' it sends that validator and answers matching conditional
+# requests with 304. Every request's path and headers are kept in `requests`.
+class PagesServer:
+    def __init__(self, validator='etag'):
+        self.pages = {}
+        self.versions = {}      # path -> number of times its body was set
+        self.requests = []
+        self.validator = validator
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), self.make_handler())
+        self.thread = threading.Thread(
+            target=self.httpd.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.start()
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self.httpd.server_port, path)
+
+    def set_page(self, path, body):
+        self.pages[path] = body
+        self.versions[path] = self.versions.get(path, 0) + 1
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+        self.thread.join()
+
+    def make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.requests.append((self.path, dict(self.headers)))
+                body = server.pages.get(self.path)
+                if body is None:
+                    self.send_error(404)
+                    return
+                version = server.versions[self.path]
+                etag = '"v{}"'.format(version)
+                last_modified = 'Mon, 0{} Jan 2024 00:00:00 GMT'.format(
+                    version)
+                if server.validator == 'etag':
+                    headers = {'ETag': etag}
+                    not_modified = self.headers.get('If-None-Match') == etag
+                else:
+                    headers = {'Last-Modified': last_modified}
+                    not_modified = (self.headers.get('If-Modified-Since')
+                                    == last_modified)
+                if not_modified:
+                    self.send_response(304)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                for k, v in headers.items():
+                    self.send_header(k, v)
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+@pytest.fixture
+def server():
+    server = PagesServer()
+    yield server
+    server.stop()
+
+
+def test_etag_revalidation(server, tmp_path):
+    server.set_page('/card', b'<h1>Card</h1>')
+    cache = http_cache.HttpCache(str(tmp_path))
+
+    first = cache.fetch(server.url('/card'))
+    second = cache.fetch(server.url('/card'))
+
+    assert (first.status_code, first.from_cache) == (200, False)
+    assert (second.status_code, second.from_cache) == (304, True)
+    assert second.content == b'<h1>Card</h1>'
+    assert server.requests[1][1].get('If-None-Match') == '"v1"'
+    assert cache.stats == {'hits': 1, 'misses': 1, 'bytes_downloaded': 13,
+                           'bytes_saved': 13}
+
+
+def test_last_modified_revalidation(tmp_path):
+    server = PagesServer(validator='last_modified')
+    try:
+        server.set_page('/card', b'old')
+        cache = http_cache.HttpCache(str(tmp_path))
+        cache.fetch(server.url('/card'))
+        assert cache.fetch(server.url('/card')).from_cache
+
+        server.set_page('/card', b'new')
+        r = cache.fetch(server.url('/card'))
+        assert (r.status_code, r.content, r.from_cache) == (200, b'new', False)
+        assert server.requests[2][1].get('If-Modified-Since') == (
+            'Mon, 01 Jan 2024 00:00:00 GMT')
+    finally:
+        server.stop()
+
+
+def test_changed_page_is_downloaded_again(server, tmp_path):
+    server.set_page('/card', b'first version')
+    cache = http_cache.HttpCache(str(tmp_path))
+    cache.fetch(server.url('/card'))
+
+    server.set_page('/card', b'second version')
+    r = cache.fetch(server.url('/card'))
+
+    assert (r.status_code, r.content, r.from_cache) == (
+        200, b'second version', False)
+    assert cache.stats['misses'] == 2
+    assert cache.stats['hits'] == 0
+
+
+def test_entries_persist_between_runs(server, tmp_path):
+    server.set_page('/card', b'<h1>Card</h1>')
+    with http_cache.HttpCache(str(tmp_path)) as cache:
+        cache.fetch(server.url('/card'))
+
+    cache = http_cache.HttpCache(str(tmp_path))
+    r = cache.fetch(server.url('/card'))
+    assert r.from_cache
+    assert r.content == b'<h1>Card</h1>'
+
+
+def test_errors_are_not_cached(server, tmp_path):
+    cache = http_cache.HttpCache(str(tmp_path))
+    r = cache.fetch(server.url('/missing'))
+    assert r.status_code == 404
+    assert server.url('/missing') not in cache.entries
+
+
+def test_least_recently_used_pages_are_evicted(server, tmp_path):
+    for path in ['/a', '/b', '/c']:
+        server.set_page(path, path.encode('utf-8') * 50)    # 100 bytes each
+    cache = http_cache.HttpCache(str(tmp_path), max_bytes=250)
+
+    cache.fetch(server.url('/a'))
+    cache.fetch(server.url('/b'))
+    cache.fetch(server.url('/a'))   # /a is now more recently used than /b
+    cache.fetch(server.url('/c'))
+
+    assert sorted(cache.entries) == [server.url('/a'), server.url('/c')]
+    assert cache.read_blob(hashlib.sha256(b'/b' * 50).hexdigest()) is None
+    # an evicted page is downloaded in full again
+    assert not cache.fetch(server.url('/b')).from_cache
+
+
+def test_shared_body_is_kept_while_any_url_uses_it(server, tmp_path):
+    server.set_page('/a', b'same' * 25)
+    server.set_page('/b', b'same' * 25)
+    server.set_page('/c', b'other' * 20)
+    cache = http_cache.HttpCache(str(tmp_path), max_bytes=200)
+
+    cache.fetch(server.url('/a'))
+    cache.fetch(server.url('/b'))
+    cache.fetch(server.url('/c'))
+
+    # /a and /b share one 100 byte body, so nothing needs evicting
+    assert len(cache.entries) == 3
+    assert cache.fetch(server.url('/a')).from_cache
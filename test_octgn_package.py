@@ -0,0 +1,46 @@
+# Tests for incremental builds of OCTGN set files. Run with `python -m pytest`.
+
+import xml.etree.ElementTree as ET
+import arkham_common
+import octgn_image_pack
+import octgn_package
+
+
+def make_set_without_card_ids():
+    cards = []
+    for i in range(3):
+        cards.append({
+            'number': str(i + 1),
+            'quantity': '1',
+            'front': {'name': 'Card {}'.format(i + 1),
+                      'image_url': 'http://example.com/{}.jpg'.format(i + 1),
+                      'data': {'Type': 'Asset', 'Text': 'Text.'}},
+        })
+    cards[2]['back'] = {'name': 'Card 3',
+                        'image_url': 'http://example.com/3b.jpg',
+                        'data': {'Text': 'Back.'}}
+    return {'id': '7d3a9c1e-5b2f-4e8a-9c61-2f4d8b0a1e53', 'name': 'Test Set',
+            'type': 'Other', 'cards': cards}
+
+
+def get_set_xml_card_ids(path):
+    return [tag.attrib['id'] for tag in ET.parse(path).iterfind('./cards/card')]
+
+
+def test_up_to_date_set_gets_card_ids_from_set_xml(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    set_file = arkham_common.create_set_file(
+        make_set_without_card_ids(), str(tmp_path / 'set.json'))
+
+    first = arkham_common.load_set(set_file, typed=True)
+    set_path = octgn_package.create_set_data(first, '.state')
+    ids = get_set_xml_card_ids(set_path)
+    assert [card['id'] for card in first['cards']] == ids
+
+    second = arkham_common.load_set(set_file, typed=True)
+    assert octgn_package.create_set_data(second, '.state') == set_path
+    assert get_set_xml_card_ids(set_path) == ids    # not rewritten
+    assert [card['id'] for card in second['cards']] == ids
+
+    jobs = octgn_image_pack.get_card_image_jobs(second, 'Cards')
+    assert [job[0] for job in jobs] == ids + ids[2:]